@@ -0,0 +1,108 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is espull, a log extractor for talos logs stored in ES.
+#
+# The Initial Developer of the Original Code is
+# Stephen Lewchuk (slewchuk@mozilla.com).
+# Portions created by the Initial Developer are Copyright (C) 2011
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+import json
+import socket
+import urllib2
+
+__all__ = ['aggregation_body', 'search_aggregation', 'aggregation_records']
+
+# upper bound on the number of terms returned for each group field
+MAX_BUCKETS = 10000
+
+def aggregation_body(query, group_fields, value_field, percents):
+  """ Builds a search body which groups hits by each of group_fields in turn
+
+      Each innermost bucket holds the mean and percentiles of value_field.
+  """
+  aggs = {'mean' : {'avg' : {'field' : value_field}},
+          'percentiles' : {'percentiles' : {'field' : value_field,
+                                            'percents' : percents}},
+         }
+  for field in reversed(group_fields):
+    aggs = {field : {'terms' : {'field' : field, 'size' : MAX_BUCKETS},
+                     'aggs' : aggs}}
+
+  return {'query' : query.serialize(), 'size' : 0, 'aggs' : aggs}
+
+def search_aggregation(address, index, body, timeout=None):
+  """ Posts an aggregation search straight to the server
+
+      Failures to connect are raised as the underlying socket.error so a
+      NodePool retries them on another node.
+  """
+  url = "http://%s/%s/_search" % (address, index)
+  print "Aggregating: %s" % url
+  request = urllib2.Request(url, json.dumps(body), {'Content-Type' : 'application/json'})
+  kwargs = {}
+  if timeout is not None:
+    kwargs['timeout'] = timeout
+  try:
+    conn = urllib2.urlopen(request, **kwargs)
+  except urllib2.HTTPError:
+    raise
+  except urllib2.URLError, e:
+    if isinstance(e.reason, socket.error):
+      raise e.reason
+    raise
+  try:
+    return json.load(conn)
+  finally:
+    conn.close()
+
+def aggregation_records(response, group_fields, percents):
+  """ Flattens nested aggregation buckets into one record per group """
+  records = []
+
+  def walk(aggs, depth, record):
+    if depth == len(group_fields):
+      record['count'] = aggs['doc_count']
+      record['mean'] = aggs['mean']['value']
+      # ES keys the values by its own rendering of each percent ("99.95", "50.0")
+      values = dict((float(k), v) for k, v in aggs['percentiles']['values'].items())
+      for p in percents:
+        record['p%g' % p] = values.get(float(p))
+      records.append(record)
+      return
+
+    field = group_fields[depth]
+    for bucket in aggs[field]['buckets']:
+      child = record.copy()
+      child[field] = bucket['key']
+      walk(bucket, depth + 1, child)
+
+  walk(response['aggregations'], 0, {})
+  return records
@@ -35,14 +35,32 @@
 # ***** END LICENSE BLOCK *****
 
 import math
-import urllib2
+import copy
+import bisect
 import re
-import StringIO
-from gzip import GzipFile
-from logparser import CorruptParser
+import random
+from multiprocessing.pool import ThreadPool
+from logparser import LogParser, CorruptExtractor, PageloadExtractor, TestExtractor
+from logcache import LogCache, open_log
+from columns import ColumnBuffer
+import vectorized
+
+__all__ = ['TestSuite', 'vectorize_suites', 'BuildAnalyser', 'ComponentAnalyser', 'RunAnalyser',
+           'CorruptAnalyser', 'RunDifferenceAnalyser', 'SummaryAnalyser', 'FullLogAnalyser',
+           'ChangepointAnalyser']
+
+def sorted_median(d):
+  if len(d) % 2 == 1:
+    return d[len(d)/2]
+  return (d[len(d)/2 - 1] + d[len(d)/2])/2
 
-__all__ = ['TestSuite', 'BuildAnalyser', 'ComponentAnalyser', 'RunAnalyser', 'CorruptAnalyser',
-           'RunDifferenceAnalyser']
+def sorted_average(d):
+  total = sum(d)
+  size = len(d)
+  avg = total/size
+  diffs = [pow((x - avg),2) for x in d]
+  std_dev = math.sqrt(sum(diffs)/size)
+  return (avg, std_dev)
 
 def get_median(data, strip_max=False, strip_first=False):
   d = data
@@ -51,9 +69,7 @@ def get_median(data, strip_max=False, strip_first=False):
   d = sorted(d)
   if strip_max:
     d = d[:-1]
-  if len(d) % 2 == 1:
-    return d[len(d)/2]
-  return (d[len(d)/2 - 1] + d[len(d)/2])/2
+  return sorted_median(d)
 
 def get_average(data, strip_max=False, strip_first=False):
   d = data
@@ -62,74 +78,338 @@ def get_average(data, strip_max=False, strip_first=False):
   d = sorted(d)
   if strip_max:
     d = d[:-1]
-  total = sum(d)
-  size = len(d)
-  avg = total/size
-  diffs = [pow((x - avg),2) for x in d]
-  std_dev = math.sqrt(sum(diffs)/size)
-  return (avg, std_dev)
+  return sorted_average(d)
+
+def get_percentile(data, percent):
+  """ Linearly interpolated percentile of a sorted list """
+  pos = (len(data) - 1) * percent / 100.0
+  lower = int(math.floor(pos))
+  upper = int(math.ceil(pos))
+  return data[lower] + (data[upper] - data[lower]) * (pos - lower)
+
+def _cusum_range(values, mean):
+  total = 0
+  high = 0
+  low = 0
+  for v in values:
+    total += v - mean
+    if total > high:
+      high = total
+    elif total < low:
+      low = total
+  return high - low
+
+# CUSUM ranges below this many standard deviations times the root of the
+# series length are never confident changes, so such series skip the
+# bootstrap.  Without a change the 95th percentile of the scaled range grows
+# from about 1.43 for 20 values towards Kuiper's 1.75, this leaves a margin
+# below the shortest series checked.
+cusum_screen = 1.2
+
+# reorderings drawn at once by the numpy bootstrap
+bootstrap_chunk = 100
+
+def find_changepoint(values, rand, bootstraps=1000, confidence=None):
+  """ Finds the most likely change in level of a series with a CUSUM test
+
+      The change is placed where the cumulative sum of differences from the
+      mean is furthest from zero.  The confidence is the fraction of
+      bootstrap reorderings of the series whose cumulative sums cover a
+      smaller range, drawn with numpy when it is available.  Series whose
+      range doesn't pass cusum_screen get a confidence of 0 without being
+      bootstrapped.  Given a confidence, bootstrapping stops once it can't be
+      reached and the confidence returned only counts the reorderings drawn.
+      Returns (pos, conf, mag) where pos is the index of the first value
+      after the change and mag the difference in mean across it.
+  """
+  size = len(values)
+  if size < 2:
+    return None
+  mean = sum(values)/size
+
+  total = 0
+  furthest = 0
+  pos = 0
+  for (i, v) in enumerate(values[:-1]):
+    total += v - mean
+    if abs(total) > furthest:
+      furthest = abs(total)
+      pos = i + 1
+  if pos == 0:
+    return None
+
+  before = values[:pos]
+  after = values[pos:]
+  mag = sum(after)/len(after) - sum(before)/len(before)
+
+  original = _cusum_range(values, mean)
+  std_dev = math.sqrt(sum([pow(v - mean, 2) for v in values])/size)
+  if original < cusum_screen * std_dev * math.sqrt(size):
+    return (pos, 0.0, mag)
+
+  # the most reorderings that may cover a range as large before conf is unreachable
+  allowed = bootstraps
+  if confidence is not None:
+    allowed = bootstraps - int(math.ceil(confidence * bootstraps))
+  smaller = 0
+  drawn = 0
+  if vectorized.available():
+    numpy_rand = vectorized.numpy.random.RandomState(rand.getrandbits(32))
+    while drawn < bootstraps and drawn - smaller <= allowed:
+      chunk = min(bootstrap_chunk, bootstraps - drawn)
+      ranges = vectorized.cusum_ranges(values, mean, numpy_rand, chunk)
+      smaller += int((ranges < original).sum())
+      drawn += chunk
+  else:
+    shuffled = list(values)
+    while drawn < bootstraps and drawn - smaller <= allowed:
+      rand.shuffle(shuffled)
+      if _cusum_range(shuffled, mean) < original:
+        smaller += 1
+      drawn += 1
+  return (pos, float(smaller)/bootstraps, mag)
 
 class TestComponent(object):
+  """ The runs of one component of a test
+
+      Statistics are cached keyed by (statistic, strip_max, strip_first) so
+      analysers sharing a component only compute each of them once.  Every
+      variant is derived from a single sort of the values: removing the first
+      run is a bisect into the sorted values and removing the max drops the
+      last element.
+  """
   def __init__(self, values):
     self.values = values
+    self.first = values[0]
+    self.count = len(values)
     self.min = min(values)
     self.max = max(values)
+    self.stats = {}
+    self._sorted = None
+    self._sorted_stripped = None
+
+  def get_sorted(self, strip_first=False):
+    if self._sorted is None:
+      self._sorted = sorted(self.values)
+    if not strip_first:
+      return self._sorted
+    if self._sorted_stripped is None:
+      d = list(self._sorted)
+      del d[bisect.bisect_left(d, self.values[0])]
+      self._sorted_stripped = d
+    return self._sorted_stripped
+
+  def _get_stat(self, stat, func, kwargs):
+    strip_max = kwargs.get('strip_max', False)
+    strip_first = kwargs.get('strip_first', False)
+    key = (stat, strip_max, strip_first)
+    if key not in self.stats:
+      d = self.get_sorted(strip_first)
+      if strip_max:
+        d = d[:-1]
+      self.stats[key] = func(d)
+    return self.stats[key]
 
   # For TP tests
   def get_median(self, **kwargs):
-    return get_median(self.values, **kwargs)
+    return self._get_stat('median', sorted_median, kwargs)
 
   # For TS Tets
   def get_average(self, **kwargs):
-    return get_average(self.values, **kwargs)
+    return self._get_stat('average', sorted_average, kwargs)
 
   def __len__(self):
     return len(self.values)
 
+class BatchComponent(TestComponent):
+  """ A component whose runs are a row of a vectorized.ComponentBatch
+
+      Statistics the batch computed are looked up in it, anything else falls
+      back to TestComponent with the runs copied out of the batch.
+  """
+  def __init__(self, batch, row):
+    self.batch = batch
+    self.row = row
+    self.stats = {}
+    self._values = None
+    self._sorted = None
+    self._sorted_stripped = None
+
+  @property
+  def values(self):
+    if self._values is None:
+      self._values = self.batch.values(self.row)
+    return self._values
+
+  first = property(lambda self: self.batch.column('first')[self.row])
+  count = property(lambda self: self.batch.column('count')[self.row])
+  min = property(lambda self: self.batch.column('min')[self.row])
+  max = property(lambda self: self.batch.column('max')[self.row])
+
+  def _get_stat(self, stat, func, kwargs):
+    key = (stat, kwargs.get('strip_max', False), kwargs.get('strip_first', False))
+    value = self.batch.get(key, self.row)
+    if value is None:
+      return TestComponent._get_stat(self, stat, func, kwargs)
+    return value
+
+  def __len__(self):
+    return self.count
+
 class TestSuite(object):
-  def __init__(self, data, is_ts=False):
+  """ The components of one testruns document
+
+      The columns give a value for every component in the order of
+      components.items(), which for a suite vectorize_suites filled in are
+      slices of its batch.  Without parse the components are left for
+      vectorize_suites.
+  """
+  def __init__(self, data, is_ts=False, parse=True):
     self._data = data
     self.is_ts = is_ts
-    self.components = {}
-    for key, value in self._data.items():
-      self.components[key] = TestComponent([float(v) for v in value.split(',')])
+    self.batch = None
+    self.rows = None
+    self._components = {}
+    if parse:
+      for key, value in self._data.items():
+        self._components[key] = TestComponent([float(v) for v in value.split(',')])
+      self.names = self._components.keys()
+    self._old_average = None
+    self._new_average = None
+
+  def set_batch(self, batch, names, start):
+    """ Takes the components named from the batch rows starting at start """
+    self.batch = batch
+    self.names = names
+    self.rows = (start, start + len(names))
+    self._components = None
+
+  @property
+  def components(self):
+    if self._components is None:
+      rows = dict(zip(self.names, xrange(*self.rows)))
+      # inserted in the same order as a parsed suite so they iterate alike
+      self._components = {}
+      for key in self._data.keys():
+        self._components[key] = BatchComponent(self.batch, rows[key])
+    return self._components
 
   def __len__(self):
+    if self.batch is not None:
+      return len(self.names)
     return len(self.components)
 
+  def column(self, name):
+    """ The first, count, min or max of every component """
+    if self.batch is not None:
+      return self.batch.column(name)[self.rows[0]:self.rows[1]]
+    return [getattr(comp, name) for comp in self.components.values()]
+
+  def _statistics(self, stat, getter, kwargs):
+    if self.batch is not None:
+      key = (stat, kwargs.get('strip_max', False), kwargs.get('strip_first', False))
+      values = self.batch.slice(key, self.rows[0], self.rows[1])
+      if values is not None:
+        return values
+    return [getter(comp, **kwargs) for comp in self.components.values()]
+
+  def medians(self, **kwargs):
+    return self._statistics('median', TestComponent.get_median, kwargs)
+
+  def averages(self, **kwargs):
+    return self._statistics('average', TestComponent.get_average, kwargs)
+
   @property
   def old_average(self):
-    if self.is_ts:
-      assert(len(self) == 1)
-      comp = self.components.values()[0]
-      return comp.get_average(strip_max=True)
-    else:
-      d = [comp.get_median(strip_max=True) for comp in self.components.values()]
-      return get_average(d, True)
+    if self._old_average is None:
+      if self.is_ts:
+        assert(len(self) == 1)
+        self._old_average = self.averages(strip_max=True)[0]
+      else:
+        self._old_average = get_average(self.medians(strip_max=True), True)
+    return self._old_average
 
   @property
   def new_average(self):
-    if self.is_ts:
-      assert(len(self) == 1)
-      comp = self.components.values()[0]
-      return comp.get_average()
-    else:
-      d = [comp.get_median(strip_first=True) for comp in self.components.values()]
-      return get_average(d)
+    if self._new_average is None:
+      if self.is_ts:
+        assert(len(self) == 1)
+        self._new_average = self.averages()[0]
+      else:
+        self._new_average = get_average(self.medians(strip_first=True))
+    return self._new_average
+
+def vectorize_suites(suites, statistics):
+  """ Fills in the components of suites built without parse from one ComponentBatch
+
+      statistics lists the (statistic, strip_max, strip_first) keys to
+      compute for every component at once.  Each suite's rows are laid out
+      in the order a dict of its components built by TestSuite iterates in.
+  """
+  runs = []
+  layout = []
+  for suite in suites:
+    order = {}
+    for key in suite._data.keys():
+      order[key] = None
+    names = order.keys()
+    runs.extend([suite._data[name] for name in names])
+    layout.append((suite, names))
+  if not runs:
+    return
+  batch = vectorized.ComponentBatch(runs, statistics)
+  start = 0
+  for (suite, names) in layout:
+    suite.set_batch(batch, names, start)
+    start += len(names)
 
 class BaseAnalyser(object):
   """ A base class for analysers which holds onto results """
   def __init__(self):
-    self.results = []
+    self.results = self.new_results()
     self.headers = []
     self.suffix = "NA"
     self.types = ["testruns"]
+    # source fields read beyond the parametric fields
+    self.fields = ["format", "testruns"]
+    # whether the data must arrive in starttime order
+    self.ordered = False
+    # component statistics read, as (statistic, strip_max, strip_first),
+    # which --vectorize computes for a batch at once
+    self.statistics = []
+    self.sink = None
+    self.threshold = 0
+
+  def new_results(self):
+    return []
 
   def get_results(self):
     return [result for result in self.results]
 
   def flush(self):
-    self.results = []
+    self.results = self.new_results()
+
+  def set_sink(self, sink, threshold):
+    """ Streams results to sink whenever at least threshold of them are held """
+    self.sink = sink
+    self.threshold = threshold
+
+  def drain(self):
+    """ Passes the results held to the sink if there are enough of them """
+    if self.sink is not None and len(self.results) >= self.threshold:
+      self.sink(self.get_results())
+      self.flush()
+
+  def split(self):
+    """ Returns an empty copy for parsing part of the data elsewhere """
+    clone = copy.copy(self)
+    clone.results = clone.new_results()
+    clone.sink = None
+    return clone
+
+  def merge(self, other):
+    """ Adds the results of a copy returned by split """
+    self.results.extend(other.results)
 
   def get_headers(self):
     return self.headers
@@ -140,11 +420,25 @@ class BaseAnalyser(object):
   def types_parsed(self):
     return self.types
 
+  def get_fields(self):
+    return self.fields
+
+  def configure(self, args):
+    """ Picks up any analyser specific options """
+    pass
+
+  def finish(self):
+    """ Called once all the data has been parsed """
+    pass
+
 class BuildAnalyser(BaseAnalyser):
   def __init__(self):
     BaseAnalyser.__init__(self)
     self.headers = ['graph_result', 'new_result', 'graph_std', 'new_std']
     self.suffix = "builds"
+    # old_average and new_average, of the medians or the single ts component
+    self.statistics = [('median', True, False), ('median', False, True),
+                       ('average', True, False), ('average', False, False)]
 
   def parse_data(self, data, template):
     result = template.copy()
@@ -152,38 +446,220 @@ class BuildAnalyser(BaseAnalyser):
     (result['new_result'], result['new_std']) = data.new_average
     self.results.append(result)
 
-class ComponentAnalyser(BaseAnalyser):
-  """ Returns a result for each component of a test """
+class SummaryAnalyser(BaseAnalyser):
+  """ Summarises the new build result of each group of builds
+
+      The summaries are only produced once all the data has been parsed.
+  """
+
+  def __init__(self, group_fields, percents):
+    BaseAnalyser.__init__(self)
+    self.group_fields = group_fields
+    self.percents = percents
+    self.groups = {}
+    self.headers = ['count', 'mean'] + ['p%g' % p for p in percents]
+    self.suffix = "summary"
+    # new_average, of the medians or the single ts component
+    self.statistics = [('median', False, True), ('average', False, False)]
+
+  def parse_data(self, data, template):
+    key = tuple([template.get(field) for field in self.group_fields])
+    (value, _) = data.new_average
+    self.groups.setdefault(key, []).append(value)
+
+  def split(self):
+    clone = BaseAnalyser.split(self)
+    clone.groups = {}
+    return clone
+
+  def merge(self, other):
+    BaseAnalyser.merge(self, other)
+    for (key, values) in other.groups.items():
+      self.groups.setdefault(key, []).extend(values)
+
+  def finish(self):
+    for key in sorted(self.groups.keys()):
+      values = sorted(self.groups[key])
+      result = dict(zip(self.group_fields, key))
+      result['count'] = len(values)
+      result['mean'] = sum(values)/len(values)
+      for p in self.percents:
+        result['p%g' % p] = get_percentile(values, p)
+      self.results.append(result)
+    self.groups = {}
+
+class ChangepointAnalyser(BaseAnalyser):
+  """ Finds changes in the new median of each (os, test_name) series
+
+      Builds are expected in starttime order; any older than the last change
+      found in their series are dropped.  Every check_every builds the
+      series since its last change is tested, and a change found with enough
+      confidence at least min_segment builds from either end is reported
+      along with any earlier changes found by splitting the series before
+      it, which are held to the same min_segment.  The series then restarts
+      after the change.  Series longer than max_window without a change lose
+      their oldest builds.  What is left of each series is split into as
+      many changes as it holds at the end.
+
+      Each result is the last build before a change with the mag and conf
+      of the change.
+  """
+
+  bootstraps = 1000
+  confidence = 0.95
+  check_every = 10
+  min_segment = 10
+  max_window = 500
 
   def __init__(self):
     BaseAnalyser.__init__(self)
+    self.headers = ['test_name', 'mag', 'conf']
+    self.suffix = "breaks"
+    self.ordered = True
+    self.statistics = [('median', False, True)]
+    self.series = {}
+    self.deferred = None
+    self.dropped = 0
+    self.rand = random.Random(0)
+
+  def parse_data(self, data, template):
+    for name, comp in data.components.items():
+      point = (template.get('starttime'), comp.get_median(strip_first=True), template)
+      if self.deferred is not None:
+        self.deferred.append(((template.get('os'), name), point))
+      else:
+        self.add_point((template.get('os'), name), point)
+
+  def add_point(self, key, point):
+    if key not in self.series:
+      self.series[key] = {'points' : [], 'floor' : None, 'added' : 0}
+    series = self.series[key]
+    if series['floor'] is not None and point[0] <= series['floor']:
+      self.dropped += 1
+      return
+    series['points'].append(point)
+    series['added'] += 1
+    if series['added'] >= self.check_every:
+      series['added'] = 0
+      self.check_series(key, series)
+
+  def find_change(self, points):
+    """ The (pos, conf, mag) of a confident change at least min_segment from both ends or None """
+    if len(points) < 2 * self.min_segment:
+      return None
+    values = [value for (_, value, _) in points]
+    change = find_changepoint(values, self.rand, self.bootstraps, self.confidence)
+    if (change is None or change[1] < self.confidence or
+        not self.min_segment <= change[0] <= len(points) - self.min_segment):
+      return None
+    return change
+
+  def split_changes(self, key, points):
+    """ Recursively splits points at each confident change, yielding results """
+    change = self.find_change(points)
+    if change is None:
+      return
+    (pos, conf, mag) = change
+    for result in self.split_changes(key, points[:pos]):
+      yield result
+    result = points[pos - 1][2].copy()
+    result['test_name'] = key[1]
+    result['mag'] = mag
+    result['conf'] = conf
+    yield result
+    for result in self.split_changes(key, points[pos:]):
+      yield result
+
+  def check_series(self, key, series):
+    points = series['points']
+    change = self.find_change(points)
+    if change is not None:
+      pos = change[0]
+      self.results.extend(self.split_changes(key, points[:pos]))
+      result = points[pos - 1][2].copy()
+      result['test_name'] = key[1]
+      result['mag'] = change[2]
+      result['conf'] = change[1]
+      self.results.append(result)
+      series['floor'] = points[pos - 1][0]
+      series['points'] = points[pos:]
+    elif len(points) > self.max_window:
+      series['points'] = points[-self.max_window:]
+
+  def split(self):
+    # copies only collect builds, the changes are found as they are merged
+    clone = BaseAnalyser.split(self)
+    clone.series = {}
+    clone.deferred = []
+    return clone
+
+  def merge(self, other):
+    BaseAnalyser.merge(self, other)
+    for (key, point) in other.deferred:
+      self.add_point(key, point)
+
+  def finish(self):
+    for key in sorted(self.series.keys()):
+      self.results.extend(self.split_changes(key, self.series[key]['points']))
+    self.series = {}
+    if self.dropped:
+      print "Dropped %d builds older than a change in their series" % self.dropped
+
+class ColumnAnalyser(BaseAnalyser):
+  """ A base class for analysers with many results which are held in a ColumnBuffer
+
+      numeric maps the numeric result columns to their array typecodes.
+      The buffer is handed to the formatters as is, rather than copied.
+  """
+  numeric = {}
+
+  def new_results(self):
+    return ColumnBuffer(self.numeric)
+
+  def get_results(self):
+    return self.results
+
+class ComponentAnalyser(ColumnAnalyser):
+  """ Returns a result for each component of a test """
+
+  numeric = {'build_id' : 'l', 'test_runs' : 'l', 'test_0' : 'l', 'max' : 'd', 'min' : 'd',
+             'graph_median' : 'd', 'new_median' : 'd', 'new_average' : 'd', 'new_std_dev' : 'd'}
+
+  def __init__(self):
+    ColumnAnalyser.__init__(self)
     self.max_tests = -1
     self.build_index = 1
     self.headers = ['build_id', 'test_name', 'test_runs', 'max', 'min', 'test_0', 'graph_median', 'new_median', 'new_average', 'new_std_dev']
     self.suffix = "components"
+    self.statistics = [('median', True, False), ('median', False, True), ('average', False, True)]
 
   def parse_data(self, data, template):
-    for name, comp in data.components.items():
-      result = template.copy()
-      result['test_name'] = name
-      result['test_0'] = int(comp.values[0])
-      result['max'] = comp.max
-      result['min'] = comp.min
-      result['graph_median'] = comp.get_median(strip_max=True)
-      result['new_median'] = comp.get_median(strip_first=True)
-      (avg, std_dev) = comp.get_average(strip_first=True)
-      result['new_average'] = avg
-      result['new_std_dev'] = std_dev
-      result['test_runs'] = len(comp.values)
-      result['build_id'] = self.build_index
-      self.results.append(result)
+    averages = data.averages(strip_first=True)
+    result = {'test_name' : data.names,
+              'test_0' : [int(first) for first in data.column('first')],
+              'max' : data.column('max'),
+              'min' : data.column('min'),
+              'graph_median' : data.medians(strip_max=True),
+              'new_median' : data.medians(strip_first=True),
+              'new_average' : [avg for (avg, std_dev) in averages],
+              'new_std_dev' : [std_dev for (avg, std_dev) in averages],
+              'test_runs' : data.column('count')}
+    build = template.copy()
+    build['build_id'] = self.build_index
+    self.results.append_rows(len(data), build, result)
     self.build_index += 1
 
-class RunAnalyser(BaseAnalyser):
+  def merge(self, other):
+    BaseAnalyser.merge(self, other)
+    self.build_index = other.build_index
+
+class RunAnalyser(ColumnAnalyser):
   """ Returns a result for each run of every component of a test """
 
+  numeric = {'build_id' : 'l', 'run_num' : 'l', 'value' : 'l'}
+
   def __init__(self):
-    BaseAnalyser.__init__(self)
+    ColumnAnalyser.__init__(self)
     self.build_index = 1
     self.headers = ['build_id', 'test_name', 'run_num', 'value']
     self.suffix = "runs"
@@ -193,14 +669,16 @@ class RunAnalyser(BaseAnalyser):
       test_template = template.copy()
       test_template['build_id'] = self.build_index
       test_template['test_name'] = name
-      for pos, value in enumerate(comp.values):
-        result = test_template.copy()
-        result['run_num'] = pos
-        # cast to int so as not to give false impression of precision
-        result['value'] = int(value)
-        self.results.append(result)
+      # cast to int so as not to give false impression of precision
+      values = [int(value) for value in comp.values]
+      self.results.append_rows(len(values), test_template,
+                               {'run_num' : xrange(len(values)), 'value' : values})
     self.build_index += 1
 
+  def merge(self, other):
+    BaseAnalyser.merge(self, other)
+    self.build_index = other.build_index
+
 class RunDifferenceAnalyser(RunAnalyser):
   """ Returns a result for the difference in run value from the previous """
 
@@ -211,45 +689,165 @@ class RunDifferenceAnalyser(RunAnalyser):
   def parse_data(self, data, template):
     for name, comp in data.components.items():
       test_template = template.copy()
-      test_template['index'] = self.index
-      self.index += 1
+      test_template['build_id'] = self.build_index
       test_template['test_name'] = name
       last_value = 0
-      for pos, value in enumerate(comp.values):
-        result = test_template.copy()
-        result['run_num'] = pos
+      diffs = []
+      for value in comp.values:
         # cast to int so as not to give false impression of precision
-        result['value'] = int(value) - last_value
+        diffs.append(int(value) - last_value)
         last_value = int(value)
-        self.results.append(result)
+      self.results.append_rows(len(diffs), test_template,
+                               {'run_num' : xrange(len(diffs)), 'value' : diffs})
+    self.build_index += 1
 
-class CorruptAnalyser(BaseAnalyser):
-  """ Downloads full logs and searches for Corrupt JPEG messages """
+pageUrlRe = "^http://localhost/page_load_test/%s/(.*?)$"
+
+def page_name(testsuite, page):
+  """ The page's path within the testsuite's page set, or None if it isn't in it """
+  m = re.match(pageUrlRe % testsuite, page)
+  if not m:
+    print "unmatched url: %s" % page
+    return None
+  return m.group(1)
+
+class LogAnalyser(BaseAnalyser):
+  """ A base class for analysers which download and parse the full log of each build
+
+      Logs can be downloaded by a pool of threads, in which case the results
+      are gathered in order when they are asked for, and kept in a LogCache.
+      Subclasses list the extractors to run over each log in extractors and
+      turn their output into results in build_results.
+  """
 
   def __init__(self):
     BaseAnalyser.__init__(self)
+    self.types = ["builds"]
+    self.fields = ["logurl"]
+    self.cache = None
+    self.pool = None
+    self.pending = []
+
+  def configure(self, args):
+    if args.get("log_cache"):
+      self.cache = LogCache(args.get("log_cache"))
+    if args.get("log_workers", 1) > 1:
+      self.pool = ThreadPool(args.get("log_workers"))
+
+  def extractors(self):
+    raise NotImplementedError
+
+  def build_results(self, extractors, template):
+    raise NotImplementedError
+
+  def parse_log(self, url, template):
+    extractors = self.extractors()
+    data_file = open_log(url, self.cache)
+    try:
+      LogParser(extractors).parse(data_file)
+    finally:
+      data_file.close()
+    return self.build_results(extractors, template)
+
+  def parse_data(self, data, template):
+    if self.pool is None:
+      self.results.extend(self.parse_log(data['logurl'], template))
+    else:
+      self.pending.append(self.pool.apply_async(self.parse_log, (data['logurl'], template)))
+
+  def get_results(self):
+    for pending in self.pending:
+      self.results.extend(pending.get())
+    self.pending = []
+    return BaseAnalyser.get_results(self)
+
+  def drain(self):
+    # collect the downloads which have finished, stopping at the first which
+    # hasn't so the results stay in order
+    while self.pending and self.pending[0].ready():
+      self.results.extend(self.pending.pop(0).get())
+    if self.sink is not None and len(self.results) >= self.threshold:
+      self.sink(BaseAnalyser.get_results(self))
+      self.flush()
+
+  def split(self):
+    # threads don't cross processes, the copies download serially
+    clone = BaseAnalyser.split(self)
+    clone.pool = None
+    clone.pending = []
+    return clone
+
+  def finish(self):
+    if self.pool is not None:
+      self.pool.close()
+
+class CorruptAnalyser(LogAnalyser):
+  """ Downloads full logs and searches for Corrupt JPEG messages """
+
+  def __init__(self):
+    LogAnalyser.__init__(self)
     self.headers = ['test_name', 'run_num']
     self.suffix = "corrupted"
-    self.types = self.types = ["builds"]
 
-  def parse_data(self, data, template):
-    url = data['logurl']
-    conn = urllib2.urlopen(url)
-    raw_data = conn.read()
-    data = StringIO.StringIO(raw_data)
-    data_file = GzipFile(fileobj=data)
-    parser = CorruptParser()
-    (entries, _) = parser.parse(data_file)
-    for (testsuite, cycle, page) in entries:
-      urlRe = re.compile("^http://localhost/page_load_test/%s/(.*?)$" % testsuite)
-      m = urlRe.match(page)
-      if not m:
-        print "unmatched url: %s" % page
+  def extractors(self):
+    return [CorruptExtractor()]
+
+  def build_results(self, extractors, template):
+    results = []
+    for (testsuite, cycle, page) in extractors[0].results:
+      name = page_name(testsuite, page)
+      if name is None:
         continue
       result = template.copy()
-      result['test_name'] = m.group(1)
+      result['test_name'] = name
       result['run_num'] = int(cycle) - 1
       result['testsuite'] = testsuite
-      self.results.append(result)
+      results.append(result)
+    return results
+
+class FullLogAnalyser(LogAnalyser):
+  """ Extracts page loads, corrupt pages and test extents from one pass over each log
+
+      Each result has a record_type of 'test', 'pageload' or 'corrupt' and
+      only fills in the columns which apply to it.
+  """
+
+  def __init__(self):
+    LogAnalyser.__init__(self)
+    self.headers = ['record_type', 'test_name', 'run_num', 'load_index', 'start_line',
+                    'end_line', 'page_loads']
+    self.suffix = "logs"
+
+  def extractors(self):
+    return [TestExtractor(), PageloadExtractor(), CorruptExtractor()]
+
+  def build_results(self, extractors, template):
+    (tests, pageloads, corrupt) = extractors
+    results = []
+    for (testsuite, start_line, end_line, page_loads) in tests.results:
+      result = template.copy()
+      result['record_type'] = 'test'
+      result['testsuite'] = testsuite
+      result['start_line'] = start_line
+      result['end_line'] = end_line
+      result['page_loads'] = page_loads
+      results.append(result)
+
+    for (record_type, entries) in [('pageload', pageloads.results),
+                                   ('corrupt', corrupt.results)]:
+      for entry in entries:
+        (testsuite, cycle, page) = entry[:3]
+        name = page_name(testsuite, page)
+        if name is None:
+          continue
+        result = template.copy()
+        result['record_type'] = record_type
+        result['testsuite'] = testsuite
+        result['test_name'] = name
+        result['run_num'] = int(cycle) - 1
+        if record_type == 'pageload':
+          result['load_index'] = entry[3]
+        results.append(result)
+    return results
 
 
@@ -0,0 +1,150 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is espull, a log extractor for talos logs stored in ES.
+#
+# The Initial Developer of the Original Code is
+# Stephen Lewchuk (slewchuk@mozilla.com).
+# Portions created by the Initial Developer are Copyright (C) 2011
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+import array
+import itertools
+
+__all__ = ['ColumnBuffer']
+
+class NumericColumn(object):
+  """ A column of numbers packed into an array """
+  def __init__(self, typecode):
+    self.typecode = typecode
+    self.values = array.array(typecode)
+
+  def repeat(self, value, count):
+    self.values.extend(array.array(self.typecode, [value]) * count)
+
+  def extend(self, values):
+    self.values.extend(values)
+
+  def extend_column(self, other):
+    self.values.extend(other.values)
+
+  def __iter__(self):
+    return iter(self.values)
+
+class InternedColumn(object):
+  """ A column of repetitive values stored as indexes into a table of distinct values """
+  def __init__(self):
+    self.codes = array.array('l')
+    self.table = []
+    self.lookup = {}
+
+  def code(self, value):
+    code = self.lookup.get(value)
+    if code is None:
+      code = len(self.table)
+      self.lookup[value] = code
+      self.table.append(value)
+    return code
+
+  def repeat(self, value, count):
+    self.codes.extend(array.array('l', [self.code(value)]) * count)
+
+  def extend(self, values):
+    self.codes.extend([self.code(value) for value in values])
+
+  def extend_column(self, other):
+    mapping = [self.code(value) for value in other.table]
+    self.codes.extend([mapping[code] for code in other.codes])
+
+  def __iter__(self):
+    return itertools.imap(self.table.__getitem__, self.codes)
+
+class ColumnBuffer(object):
+  """ Holds records column by column rather than as a dict per record
+
+      Numeric columns are declared up front with an array typecode, any
+      other column is interned so repeated values (parametric fields, test
+      names) are stored once.  Columns first seen part way through are
+      padded with None.
+  """
+
+  def __init__(self, numeric):
+    self.numeric = numeric
+    self.columns = {}
+    self.length = 0
+    for (name, typecode) in numeric.items():
+      self.columns[name] = NumericColumn(typecode)
+
+  def __len__(self):
+    return self.length
+
+  def _column(self, name):
+    if name not in self.columns:
+      column = InternedColumn()
+      column.repeat(None, self.length)
+      self.columns[name] = column
+    return self.columns[name]
+
+  def append_rows(self, count, constants, series):
+    """ Adds count rows, with the values in constants repeated on every row
+        and series mapping each remaining column to count values """
+    for (name, value) in constants.items():
+      self._column(name).repeat(value, count)
+    for (name, values) in series.items():
+      self._column(name).extend(values)
+    for (name, column) in self.columns.items():
+      if name not in constants and name not in series:
+        column.repeat(None, count)
+    self.length += count
+
+  def extend(self, other):
+    """ Appends the rows of another buffer """
+    for name in other.columns:
+      self._column(name)
+    for (name, column) in self.columns.items():
+      if name in other.columns:
+        column.extend_column(other.columns[name])
+      else:
+        column.repeat(None, len(other))
+    self.length += len(other)
+
+  def rows(self, headers, missing=None):
+    """ Yields a tuple per row holding the headers' values in order """
+    columns = []
+    for header in headers:
+      if header in self.columns:
+        columns.append(self.columns[header])
+      else:
+        columns.append(itertools.repeat(missing, self.length))
+    return itertools.izip(*columns)
+
+  def records(self):
+    """ Returns the rows as a list of dicts """
+    names = self.columns.keys()
+    return [dict(zip(names, row)) for row in self.rows(names)]
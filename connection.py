@@ -0,0 +1,156 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is espull, a log extractor for talos logs stored in ES.
+#
+# The Initial Developer of the Original Code is
+# Stephen Lewchuk (slewchuk@mozilla.com).
+# Portions created by the Initial Developer are Copyright (C) 2011
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+import time
+import random
+import socket
+import threading
+import pyes
+from pyes.exceptions import NoServerAvailable
+
+__all__ = ['NodePool', 'transient_errors']
+
+# failures worth retrying on another node, socket.timeout is a socket.error
+transient_errors = (socket.error, NoServerAvailable)
+
+class Node(object):
+  """ Persistent connections to one ES node along with its recent latency
+
+      A pyes.ES holds a single HTTP connection which can't be used by two
+      threads at once, so each thread gets its own, while the latency and
+      down state are shared by all of them.
+  """
+
+  # weight given to the newest latency sample
+  alpha = 0.3
+
+  def __init__(self, address, **kwargs):
+    self.address = address
+    self.kwargs = kwargs
+    self.local = threading.local()
+    self.latency = 0.0
+    self.failures = 0
+    self.down_until = 0
+
+  @property
+  def conn(self):
+    if not hasattr(self.local, "conn"):
+      self.local.conn = pyes.ES(self.address, **self.kwargs)
+    return self.local.conn
+
+  def succeeded(self, elapsed):
+    self.latency = self.alpha * elapsed + (1 - self.alpha) * self.latency
+    self.failures = 0
+    self.down_until = 0
+
+  def failed(self, backoff):
+    self.failures += 1
+    self.down_until = time.time() + backoff
+
+class NodePool(object):
+  """ Spreads ES calls over a set of nodes, retrying failures on the others
+
+      Each call goes to the available node with the lowest moving average
+      latency, so a slow node only sees traffic again once the others slow
+      down.  A call failing with a transient error marks its node down for
+      the backoff period and is retried after an exponential backoff with full
+      jitter.  Scroll continuations are never retried, as the failed request
+      may have reached the node and moved the cursor past a batch; the
+      caller has to reopen the scroll instead.
+  """
+
+  def __init__(self, addresses, retries=5, backoff=0.5, max_backoff=30, **kwargs):
+    self.nodes = [Node(address, **kwargs) for address in addresses]
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.lock = threading.Lock()
+
+  def pick_node(self):
+    now = time.time()
+    self.lock.acquire()
+    try:
+      available = [node for node in self.nodes if node.down_until <= now]
+      if not available:
+        available = [min(self.nodes, key=lambda node: node.down_until)]
+      return min(available, key=lambda node: (node.latency, random.random()))
+    finally:
+      self.lock.release()
+
+  def call(self, method, *pargs, **kwargs):
+    return self.call_retrying(self.retries, method, *pargs, **kwargs)
+
+  def call_retrying(self, retries, method, *pargs, **kwargs):
+    return self.request(retries, method,
+                        lambda node: getattr(node.conn, method)(*pargs, **kwargs))
+
+  def call_address(self, name, func, *pargs):
+    """ Calls func(address, *pargs) on a node for requests pyes can't make """
+    return self.request(self.retries, name, lambda node: func(node.address, *pargs))
+
+  def request(self, retries, name, func):
+    """ Calls func(node) on the best node, retrying transient errors on others """
+    attempt = 0
+    while True:
+      node = self.pick_node()
+      start = time.time()
+      try:
+        result = func(node)
+      except transient_errors, e:
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * pow(2, attempt)))
+        self.lock.acquire()
+        node.failed(delay)
+        self.lock.release()
+        if attempt >= retries:
+          raise
+        attempt += 1
+        print "%s failed on %s (%s), retry %d in %.1fs" % (name, node.address, e, attempt, delay)
+        time.sleep(delay)
+        continue
+
+      self.lock.acquire()
+      node.succeeded(time.time() - start)
+      self.lock.release()
+      return result
+
+  def count(self, *pargs, **kwargs):
+    return self.call("count", *pargs, **kwargs)
+
+  def search(self, *pargs, **kwargs):
+    return self.call("search", *pargs, **kwargs)
+
+  def search_scroll(self, *pargs, **kwargs):
+    return self.call_retrying(0, "search_scroll", *pargs, **kwargs)
@@ -36,12 +36,23 @@
 
 import sys
 import os
+import copy
 import argparse
 import pyes
 import json
+import threading
+import Queue
+import itertools
+import re
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from analyser import *
 from formatter import *
+from hitstore import *
+from aggregate import *
+from connection import NodePool, transient_errors
+import vectorized
 
 analyser_classes = {
     'build' : BuildAnalyser,
@@ -49,6 +60,8 @@ analyser_classes = {
     'run' : RunAnalyser,
     'corrupt' : CorruptAnalyser,
     'run_diff' : RunDifferenceAnalyser,
+    'log' : FullLogAnalyser,
+    'changepoint' : ChangepointAnalyser,
 }
 
 formatters = {
@@ -58,26 +71,41 @@ formatters = {
 
 parametric_fields = ['revision', 'machine', 'starttime', 'testgroup', 'testsuite', 'os', 'buildtype', 'tree']
 
-def parse_results(data, analysers, log_type):
-  """ Parses a testrun document into the specified analyser"""
+default_group_fields = ['revision', 'machine', 'os']
+default_percents = [50.0, 90.0]
+
+def prepare_results(data, log_type, parse=True):
+  """ Builds the template and the object passed to the analysers for a document
+
+      Without parse testruns suites are left for vectorize_suites to fill in.
+  """
   template = {}
   for field in parametric_fields:
     template[field] = data.get(field, None)
 
-  results = None
   if log_type == "testruns" and 'format' not in data:
     print "no format, skipping"
-    return
+    return None
 
   data_obj = data
   if log_type == "testruns":
-    data_obj = TestSuite(data['testruns'], data['format'] == 'ts_format')
+    data_obj = TestSuite(data['testruns'], data['format'] == 'ts_format', parse)
 
+  return (data_obj, template)
+
+def run_analysers(data_obj, template, analysers, log_type):
   for analyser in analysers:
     if log_type in analyser.types_parsed():
       analyser.parse_data(data_obj, template)
+      analyser.drain()
+
+def parse_results(data, analysers, log_type):
+  """ Parses a testrun document into the specified analyser"""
+  prepared = prepare_results(data, log_type)
+  if prepared is not None:
+    run_analysers(prepared[0], prepared[1], analysers, log_type)
 
-def generate_query(args):
+def generate_query(args, dates=True):
   query = pyes.query.ConstantScoreQuery()
 
   for field in parametric_fields:
@@ -94,7 +122,7 @@ def generate_query(args):
         or_filters.append(pyes.filters.ANDFilter(and_filters))
       query.add(pyes.filters.ORFilter(or_filters))
 
-  if "from" in args and "to" in args:
+  if dates and "from" in args and "to" in args:
     erange = pyes.utils.ESRange("date", from_value=args.get("from"), to_value=args.get("to"))
     query.add(pyes.filters.RangeFilter(erange))
 
@@ -105,6 +133,10 @@ def generate_query(args):
 def build_analysers(args):
   analyser_names = args.get("analysers", ["build"])
   analysers = []
+  if args.get("aggregate", False):
+    analysers.append(SummaryAnalyser(args.get("group_by", default_group_fields),
+                                     args.get("percents", default_percents)))
+    analyser_names = []
   for name in analyser_names:
     a_class = analyser_classes.get(name, None)
     if a_class is None:
@@ -112,14 +144,13 @@ def build_analysers(args):
       continue
     analysers.append(a_class())
 
+  for analyser in analysers:
+    analyser.configure(args)
+
   if not analysers:
     print "No recognized analyser"
     return
 
-  if args.get("dump",False):
-    print data
-    return
-
   out_format = args.get("format", "json")
   formatter = formatters.get(out_format, None)
   if formatter is None:
@@ -133,15 +164,26 @@ def build_analysers(args):
     headers.extend(analyser.get_headers())
 
     a_formatter = formatter(headers=headers)
-    if 'output' in args:
+    if 'db' in args and analyser.get_suffix() in sqlite_tables:
+      outputters.append(SQLiteOutput(args.get('db'), analyser, headers))
+    elif 'output' in args:
       outputters.append(FileOutput(args.get('output'), analyser, a_formatter))
     else:
       outputters.append(BaseOutput(analyser, a_formatter))
 
     outputters[-1].output_header()
+    if args.get("flush", 0) > 0:
+      analyser.set_sink(outputters[-1].write_records, args.get("flush"))
 
   return outputters
 
+def source_fields(outputters):
+  """ The union of the source fields the analysers need """
+  fields = set(parametric_fields)
+  for outputter in outputters:
+    fields.update(outputter.analyser.get_fields())
+  return sorted(fields)
+
 def retrieve_data(conn, query, from_i, size, args):
   print "Retrieving Data %s - %s" % (from_i, from_i + size)
   kwargs = {'query' : query,
@@ -149,59 +191,420 @@ def retrieve_data(conn, query, from_i, size, args):
             'from' : from_i,
             'indexes' : [args.get('index','talos')]
            }
+  if "fields" in args:
+    kwargs['_source'] = ','.join(args.get("fields"))
+  if "sort" in args:
+    kwargs['sort'] = args.get("sort")
   data = conn.search(**kwargs)
   print "Data: %d/%d" % (len(data["hits"]["hits"])+from_i, data["hits"]["total"])
 
   return data
 
-def analyse_data(data, outputters, args):
-  analysers = [o.analyser for o in outputters]
+def page_data(conn, query, args):
+  """ Yields batches of hits using from/size windows over the result set """
+  size = args.get("size", 20)
+  if args.get("all", False):
+    print "Retrieving count"
+    data = conn.count(query)
+    size = data.get("count")
+
+  batch = min(args.get("batch", 1000), size)
+
+  for s in range(0, size, batch):
+    data = retrieve_data(conn, query, s, batch, args)
+    yield data["hits"]["hits"]
 
+class PullError(Exception):
+  """ Raised when ES returns fewer hits than it reported matching """
+  pass
+
+def open_scroll(conn, query, args, from_starttime=None):
+  """ Opens a scroll cursor sorted by starttime, from from_starttime if given """
+  if from_starttime is not None:
+    query = copy.deepcopy(query)
+    erange = pyes.utils.ESRange("starttime", from_value=from_starttime)
+    query.add(pyes.filters.RangeFilter(erange))
+  kwargs = {'query' : query,
+            'size' : args.get("batch", 1000),
+            'indexes' : [args.get('index','talos')],
+            'scroll' : args.get("scroll"),
+            'sort' : "starttime:asc",
+           }
+  if "fields" in args:
+    kwargs['_source'] = ','.join(args.get("fields"))
+  return conn.search(**kwargs)
+
+def stream_data(conn, query, args):
+  """ Yields batches of hits from a scroll cursor sorted by starttime
+
+      The total comes back with the first response so no separate count is
+      needed.  A failed continuation can't be retried as it may have moved
+      the cursor, so instead the scroll is reopened from the last starttime
+      yielded, skipping the hits already yielded at that starttime, up to
+      the pool's retries times in a row.  That needs the starttime order,
+      which is why scrolls don't use the scan search type.  Raises PullError
+      if the cursor runs out before the total is retrieved.
+  """
+  scroll = args.get("scroll")
+  limit = None
+  if not args.get("all", False):
+    limit = args.get("size", 20)
+
+  print "Opening scroll cursor (%s)" % scroll
+  data = open_scroll(conn, query, args)
+  scroll_id = data["_scroll_id"]
+  total = data["hits"]["total"]
+  if limit is not None:
+    total = min(total, limit)
+
+  hits = data["hits"]["hits"]
+  retrieved = 0
+  reopened = False
+  failures = 0
+  last_starttime = None
+  last_ids = set()
+  while True:
+    if hits and reopened:
+      hits = [hit for hit in hits if not (hit['_source'].get('starttime') == last_starttime and
+                                          hit['_id'] in last_ids)]
+    if hits:
+      hits = hits[:total - retrieved]
+      retrieved += len(hits)
+      starttime = hits[-1]['_source'].get('starttime')
+      if starttime != last_starttime:
+        last_starttime = starttime
+        last_ids = set()
+      last_ids.update([hit['_id'] for hit in hits
+                       if hit['_source'].get('starttime') == last_starttime])
+      print "Data: %d/%d" % (retrieved, total)
+      yield hits
+    if retrieved >= total:
+      break
+    try:
+      data = conn.search_scroll(scroll_id, scroll=scroll)
+      failures = 0
+    except transient_errors, e:
+      if failures >= conn.retries:
+        raise
+      failures += 1
+      reopened = True
+      print "Scroll failed (%s), reopening from starttime %s" % (e, last_starttime)
+      data = open_scroll(conn, query, args, last_starttime)
+    hits = data["hits"]["hits"]
+    if not hits:
+      break
+    scroll_id = data.get("_scroll_id", scroll_id)
+
+  if retrieved != total:
+    raise PullError("Scroll ended after %d of %d hits" % (retrieved, total))
+
+def chunk_hits(hits, size):
+  """ Groups an iterable of hits into batches of at most size hits """
+  batch = []
+  for hit in hits:
+    batch.append(hit)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+def open_store(args):
+  filters = generate_query(args, dates=False).serialize()
+  store = HitStore(args.get("store"), args.get("index", "talos"), filters)
+  print "Using store: %s (%d hits)" % (store.path, len(store))
+  return store
+
+def sync_store(conn, store, args):
+  """ Fetches the hits newer than the latest stored starttime into the store
+
+      Hits are fetched in starttime order and stored batch by batch, so an
+      interrupted sync resumes from the last batch stored.
+  """
+  query = generate_query(args)
+  last_starttime = store.get_last_starttime()
+  if last_starttime is not None:
+    print "Syncing from starttime %s" % last_starttime
+    erange = pyes.utils.ESRange("starttime", from_value=last_starttime)
+    query.add(pyes.filters.RangeFilter(erange))
+
+  # the store keeps whole documents so any analyser can replay them
+  sync_args = dict(args)
+  sync_args.pop("fields", None)
+  sync_args["all"] = True
+  sync_args["scroll"] = args.get("scroll") or "5m"
+
+  added = 0
+  for hits in stream_data(conn, query, sync_args):
+    added += store.append(hits)
+  print "Stored %d new hits (%d total)" % (added, len(store))
+
+def replay_store(store, args):
+  """ Yields batches of stored hits inside the requested date range """
+  from_date = args.get("from")
+  to_date = args.get("to")
+  hits = store.read()
+  if from_date and to_date:
+    hits = (hit for hit in hits
+            if from_date <= hit['_source'].get('date', '')[:10] <= to_date)
+  return chunk_hits(hits, args.get("batch", 1000))
+
+def replay_dumps(paths, args):
+  """ Yields batches of hits read incrementally from dump files """
+  hits = itertools.chain.from_iterable(read_hits(path) for path in paths)
+  return chunk_hits(hits, args.get("batch", 1000))
+
+def dump_batches(batches, path):
+  """ Writes each batch of hits to a dump file as it passes through """
+  print "Dumping hits to: %s" % path
+  dump = open_hits(path, 'wb')
+  try:
+    for hits in batches:
+      write_hits(dump, hits)
+      yield hits
+  finally:
+    dump.close()
+
+def connect(args):
+  addresses = args.get("es_server", "localhost:9200").split(',')
+  print "Connecting to: %s" % ', '.join(addresses)
+  kwargs = {}
+  if "timeout" in args:
+    kwargs['timeout'] = args.get("timeout")
+  return NodePool(addresses, retries=args.get("retries", 5), **kwargs)
+
+def parse_hits(hits, analysers, vectorize=False):
+  """ Runs an iterable of hits through the analysers, returning the hits in error
+
+      When vectorizing, every suite in the batch is built first so the
+      component statistics the analysers read can be computed together.
+      Analysers which read none of them gain nothing from it.
+  """
   types = set()
+  statistics = set()
   for a in analysers:
     types.update(a.types_parsed())
+    statistics.update(a.statistics)
+  vectorize = vectorize and len(statistics) > 0
 
   errors = []
+  prepared = []
 
-  data_iter = iter(data['hits']['hits'])
-  total_data = len(data['hits']['hits'])
-  for dp in data['hits']['hits']:
+  for dp in hits:
     log_type = dp['_type']
     if log_type in types:
       if log_type == "testruns" and not dp['_source']['testruns']:
         errors.append(dp)
+      elif vectorize:
+        result = prepare_results(dp['_source'], log_type, False)
+        if result is not None:
+          prepared.append((result, log_type))
       else:
         parse_results(dp['_source'], analysers, log_type)
 
+  if prepared:
+    vectorize_suites([data_obj for ((data_obj, _), log_type) in prepared
+                      if log_type == "testruns"], sorted(statistics))
+    for ((data_obj, template), log_type) in prepared:
+      run_analysers(data_obj, template, analysers, log_type)
+
+  return errors
+
+def _parse_chunk(job):
+  (analysers, hits, vectorize) = job
+  errors = parse_hits(hits, analysers, vectorize)
+  return (analysers, errors)
+
+class ParallelParser(object):
+  """ Parses batches of hits on a pool of worker processes
+
+      Each batch is cut into chunks which are parsed by empty copies of the
+      analysers in the workers.  The copies are merged back in chunk order,
+      and each copy's build index starts after the testruns documents in
+      the chunks before it, so the output matches a serial run.
+  """
+
+  # chunks handed to each process per batch, to even out uneven chunks
+  chunks_per_process = 4
+
+  def __init__(self, processes, vectorize=False):
+    self.processes = processes
+    self.vectorize = vectorize
+    self.pool = multiprocessing.Pool(processes)
+
+  def parse_hits(self, hits, analysers):
+    hits = list(hits)
+    chunk_size = max(1, -(-len(hits) // (self.processes * self.chunks_per_process)))
+
+    types = set()
+    for a in analysers:
+      types.update(a.types_parsed())
+
+    jobs = []
+    builds = 0
+    for start in range(0, len(hits), chunk_size):
+      chunk = hits[start:start + chunk_size]
+      clones = [a.split() for a in analysers]
+      for clone in clones:
+        if hasattr(clone, 'build_index'):
+          clone.build_index += builds
+      jobs.append((clones, chunk, self.vectorize))
+      if "testruns" in types:
+        builds += len([dp for dp in chunk if dp['_type'] == "testruns" and
+                       dp['_source']['testruns'] and 'format' in dp['_source']])
+
+    errors = []
+    for (clones, e) in self.pool.imap(_parse_chunk, jobs):
+      for (analyser, clone) in zip(analysers, clones):
+        analyser.merge(clone)
+        analyser.drain()
+      errors.extend(e)
+    return errors
+
+  def close(self):
+    self.pool.close()
+    self.pool.join()
+
+def analyse_data(hits, outputters, args, parser=None):
+  """ Runs an iterable of hits through the analysers and writes their output """
+  analysers = [o.analyser for o in outputters]
+  if parser is not None:
+    errors = parser.parse_hits(hits, analysers)
+  else:
+    errors = parse_hits(hits, analysers, args.get("vectorize", False))
+
   for outputter in outputters:
     outputter.output_records()
 
   return errors
 
-def request_data(args):
-  query = generate_query(args)
-  outputters = build_analysers(args)
+_END = object()
+
+class _StageError(object):
+  """ Carries an exception from a pipeline stage to the stage after it """
+  def __init__(self, exc_info):
+    self.exc_info = exc_info
+
+def _run_stage(func, items, queue):
+  try:
+    for item in items:
+      queue.put(func(item))
+  except Exception:
+    queue.put(_StageError(sys.exc_info()))
+  queue.put(_END)
+
+def _drain(queue):
+  while True:
+    item = queue.get()
+    if item is _END:
+      return
+    if isinstance(item, _StageError):
+      raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+    yield item
+
+def _start_stage(func, items, queue):
+  thread = threading.Thread(target=_run_stage, args=(func, items, queue))
+  thread.daemon = True
+  thread.start()
+  return thread
+
+def pipeline_data(batches, outputters, args, parser=None):
+  """ Overlaps fetching, analysis and output of batches
+
+      Each stage runs in its own thread and hands batches on through a
+      bounded queue, so batch N+1 is fetched while batch N is analysed and
+      batch N-1 is written.  There is a single thread per stage so output
+      order matches the serial loop.
+  """
+  depth = args.get("pipeline", 1)
+  fetched = Queue.Queue(depth)
+  analysed = Queue.Queue(depth)
 
-  address = args.get("es_server", "localhost:9200")
-  print "Connecting to: %s" % address
-  conn = pyes.ES(address)
+  analysers = [o.analyser for o in outputters]
 
-  size = args.get("size", 20)
-  if args.get("all", False):
-    print "Retrieving count"
-    data = conn.count(query)
-    size = data.get("count")
+  # results streamed out part way through a batch go to the writer's queue
+  def stream_to_writer(i):
+    return lambda records: analysed.put(([(i, records)], []))
+  if args.get("flush", 0) > 0:
+    for (i, analyser) in enumerate(analysers):
+      analyser.set_sink(stream_to_writer(i), args.get("flush"))
 
-  batch = min(args.get("batch", 1000), size)
+  def analyse(hits):
+    if parser is not None:
+      errors = parser.parse_hits(hits, analysers)
+    else:
+      errors = parse_hits(hits, analysers, args.get("vectorize", False))
+    records = []
+    for (i, analyser) in enumerate(analysers):
+      records.append((i, analyser.get_results()))
+      analyser.flush()
+    return (records, errors)
 
-  splits = range(0, size, batch)
+  _start_stage(lambda hits: hits, batches, fetched)
+  _start_stage(analyse, _drain(fetched), analysed)
 
   errors = []
-  for s in splits:
-    data = retrieve_data(conn, query, s, batch, args)
-    e = analyse_data(data, outputters, args)
+  for (records, e) in _drain(analysed):
+    for (i, r) in records:
+      outputters[i].write_records(r)
     errors.extend(e)
 
+  return errors
+
+def aggregate_data(outputter, args):
+  """ Summarises builds with the server's aggregation API
+
+      The raw testruns can't be reduced by the server, so this needs a numeric
+      field holding a per build value to aggregate.
+  """
+  analyser = outputter.analyser
+  body = aggregation_body(generate_query(args), analyser.group_fields,
+                          args.get("agg_field"), analyser.percents)
+  conn = connect(args)
+  response = conn.call_address("aggregate", search_aggregation, args.get("index", "talos"),
+                               body, args.get("timeout"))
+  outputter.write_records(aggregation_records(response, analyser.group_fields,
+                                              analyser.percents))
+
+def fetch_batches(args, fields, conn=None, ordered=False):
+  """ Yields batches of hits from dump files, the local store or ES
+
+      ES results are sorted by starttime when ordered, the store is kept in
+      starttime order already and dumps are replayed in the order written.
+  """
+  if "replay" in args:
+    batches = replay_dumps(args.get("replay"), args)
+  elif "store" in args:
+    store = open_store(args)
+    if args.get("sync", False):
+      sync_store(conn or connect(args), store, args)
+    batches = replay_store(store, args)
+  else:
+    query = generate_query(args)
+    conn = conn or connect(args)
+    # dumps keep whole documents so any analyser can replay them
+    if "dump" not in args:
+      args = dict(args, fields=fields)
+      print "Fields: %s" % ','.join(fields)
+    if ordered:
+      args = dict(args, sort="starttime:asc")
+    if args.get("scroll"):
+      batches = stream_data(conn, query, args)
+    else:
+      batches = page_data(conn, query, args)
+
+  if "dump" in args:
+    batches = dump_batches(batches, args.get("dump"))
+
+  return batches
+
+def finish_outputters(outputters, errors, args):
+  for outputter in outputters:
+    outputter.analyser.finish()
+    if len(outputter.analyser.get_results()):
+      outputter.output_records()
+    outputter.close()
+
   if errors:
     if 'output' in args:
       output_file = args.get('output') + "_errors.json"
@@ -212,6 +615,166 @@ def request_data(args):
       print "Errors:"
       print errors
 
+def check_vectorize(args):
+  """ Turns --vectorize off when numpy isn't available """
+  if args.get("vectorize", False) and not vectorized.available():
+    print "numpy is not available, not vectorizing"
+    return dict(args, vectorize=False)
+  return args
+
+def request_data(args, conn=None):
+  outputters = build_analysers(args)
+  args = check_vectorize(args)
+
+  if args.get("aggregate", False) and "agg_field" in args:
+    aggregate_data(outputters[0], args)
+    outputters[0].close()
+    return
+
+  parser = None
+  if args.get("processes", 0) > 1:
+    parser = ParallelParser(args.get("processes"), args.get("vectorize", False))
+
+  ordered = any([o.analyser.ordered for o in outputters])
+  batches = fetch_batches(args, source_fields(outputters), conn, ordered)
+
+  try:
+    if args.get("pipeline"):
+      errors = pipeline_data(batches, outputters, args, parser)
+    else:
+      errors = []
+      for hits in batches:
+        e = analyse_data(hits, outputters, args, parser)
+        errors.extend(e)
+  finally:
+    if parser is not None:
+      parser.close()
+
+  finish_outputters(outputters, errors, args)
+
+def filter_matches(value, spec):
+  """ Whether a field value passes a filter spec the way generate_query's would
+
+      The term filters match the tokens ES indexed the value as, so the
+      value is split into word tokens before matching.
+  """
+  if value is None:
+    return False
+  tokens = set(re.split(r"\W+", unicode(value).lower()))
+  for or_seg in spec.split('|'):
+    if all([and_seg.lower() in tokens for and_seg in or_seg.split('-')]):
+      return True
+  return False
+
+# options which don't change what a job fetches
+job_output_options = ['output', 'analysers', 'format', 'aggregate', 'group_by', 'percents']
+
+def merge_jobs(jobs):
+  """ Groups jobs which fetch the same documents but for one filter field
+
+      Returns a list of (request, field, jobs) where request ORs together the
+      values of field across jobs, and field is None for unmerged jobs.  Jobs
+      without --all are never merged, their --size would limit the merged
+      query rather than each job.
+  """
+  merged = []
+  remaining = list(jobs)
+  for field in parametric_fields:
+    groups = {}
+    order = []
+    for job in remaining:
+      if field not in job or not job.get("all", False):
+        continue
+      key = json.dumps(dict([(k, v) for (k, v) in job.items()
+                             if k != field and k not in job_output_options]),
+                       sort_keys=True)
+      if key not in groups:
+        groups[key] = []
+        order.append(key)
+      groups[key].append(job)
+
+    for key in order:
+      group = groups[key]
+      if len(group) < 2:
+        continue
+      values = []
+      for job in group:
+        for seg in job[field].split('|'):
+          if seg not in values:
+            values.append(seg)
+      request = dict(group[0])
+      request[field] = '|'.join(values)
+      merged.append((request, field, group))
+      remaining = [job for job in remaining if job not in group]
+
+  merged.extend([(job, None, [job]) for job in remaining])
+  return merged
+
+def run_merged_jobs(request, field, jobs, conn):
+  """ Fetches the documents for a set of merged jobs once, routing hits to each job """
+  print "Running %s" % ', '.join([job.get('output', 'stdout') for job in jobs])
+  job_outputters = []
+  fields = set()
+  for job in jobs:
+    if 'output' in job:
+      out_dir = os.path.dirname(job.get('output'))
+      if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    outputters = build_analysers(job)
+    fields.update(source_fields(outputters))
+    job_outputters.append(outputters)
+
+  ordered = any([o.analyser.ordered for outputters in job_outputters for o in outputters])
+  job_errors = [[] for job in jobs]
+  for hits in fetch_batches(request, sorted(fields), conn, ordered):
+    for (job, outputters, errors) in zip(jobs, job_outputters, job_errors):
+      if field is not None:
+        job_hits = [hit for hit in hits if filter_matches(hit['_source'].get(field), job[field])]
+      else:
+        job_hits = hits
+      errors.extend(analyse_data(job_hits, outputters, job))
+
+  for (job, outputters, errors) in zip(jobs, job_outputters, job_errors):
+    finish_outputters(outputters, errors, job)
+
+def run_manifest(args):
+  """ Runs each job in a manifest with the command line options as defaults
+
+      The manifest is a JSON object with a list of jobs, each a set of
+      options (filters plus an output prefix) overriding the defaults.  Jobs
+      which differ only in one filter share a single query and the queries
+      run concurrently over one pool of connections.  Jobs can't use
+      --pipeline or --processes.
+  """
+  manifest_file = open(args.get("manifest"))
+  manifest = json.load(manifest_file)
+  manifest_file.close()
+
+  defaults = dict(args)
+  del defaults["manifest"]
+  defaults.update(manifest.get("defaults", {}))
+  jobs = []
+  for job in manifest["jobs"]:
+    request = dict(defaults)
+    request.update(job)
+    jobs.append(check_vectorize(request))
+
+  for job in jobs:
+    if job.get("pipeline") or job.get("processes", 0) > 1:
+      print "--pipeline and --processes can't be used with --manifest, use --workers"
+      return
+
+  merged = merge_jobs(jobs)
+  print "Running %d jobs as %d queries" % (len(jobs), len(merged))
+
+  conn = connect(args)
+  pool = ThreadPool(args.get("workers", 1))
+  results = [pool.apply_async(run_merged_jobs, (request, field, group, conn))
+             for (request, field, group) in merged]
+  pool.close()
+  for result in results:
+    result.get()
+  pool.join()
 
 
 def cli():
@@ -219,7 +782,13 @@ def cli():
 
   server_options = parser.add_argument_group('Server Specification')
   # server spec options
-  server_options.add_argument("--es-server", dest="es_server", help="ES Server to query", default="localhost:9200")
+  server_options.add_argument("--es-server", dest="es_server", default="localhost:9200",
+                              help="ES Server to query, or a comma separated list of nodes to "\
+                              "spread queries over")
+  server_options.add_argument("--retries", type=int, default=5,
+                              help="Number of times to retry a failed request, backing off "\
+                              "exponentially between attempts")
+  server_options.add_argument("--timeout", type=float, help="Request timeout in seconds")
   server_options.add_argument("--index", help="Index to query", default="talos")
 
   # query spec options
@@ -243,14 +812,72 @@ def cli():
                                  default=20, type=int)
   retrieval_options.add_argument("--batch", help="Maximum size of batch to download and analyse",
                                  default=1000, type=int)
+  retrieval_options.add_argument("--scroll", metavar="TIMEOUT",
+                                 help="Stream results through a scroll cursor kept alive for "\
+                                 "TIMEOUT (e.g. 5m) instead of paging with from/size")
+  retrieval_options.add_argument("--pipeline", metavar="DEPTH", type=int, default=0,
+                                 help="Fetch, analyse and output batches concurrently with up "\
+                                 "to DEPTH batches queued between each stage")
+
+  manifest_options = parser.add_argument_group('Manifest Options')
+  manifest_options.add_argument("--manifest", metavar="FILE",
+                                help="Run the jobs in a JSON manifest, using the other options "\
+                                "as defaults")
+  manifest_options.add_argument("--workers", type=int, default=1,
+                                help="Number of manifest queries to run concurrently")
+
+  store_options = parser.add_argument_group('Local Store Options')
+  store_options.add_argument("--replay", metavar="FILE", action="append",
+                             help="Analyse the hits in a --dump file instead of querying ES "\
+                             "(can specify multiple)")
+  store_options.add_argument("--store", metavar="DIR",
+                             help="Analyse raw hits kept in a local store under DIR instead "\
+                             "of querying ES")
+  store_options.add_argument("--sync", action="store_true",
+                             help="Fetch hits newer than those already in --store before "\
+                             "analysing")
+
+  analysis_options = parser.add_argument_group('Analysis Options')
+  analysis_options.add_argument("--vectorize", action="store_true",
+                                help="Compute component statistics for each batch at once "\
+                                "with numpy")
+  analysis_options.add_argument("--processes", type=int, default=0,
+                                help="Number of worker processes to parse each batch with")
+  analysis_options.add_argument("--log-workers", dest="log_workers", type=int, default=1,
+                                help="Number of full logs to download at once")
+  analysis_options.add_argument("--log-cache", dest="log_cache", metavar="DIR",
+                                help="Keep downloaded full logs in DIR and reuse them")
+  analysis_options.add_argument("--flush", metavar="RECORDS", type=int, default=0,
+                                help="Write an analyser's results out as soon as it holds "\
+                                "RECORDS of them rather than at the end of each batch")
+
+  agg_options = parser.add_argument_group('Aggregation Options')
+  agg_options.add_argument("--aggregate", action="store_true",
+                           help="Summarise the new build result of each group of builds "\
+                           "instead of running analysers")
+  agg_options.add_argument("--group-by", dest="group_by", action="append",
+                           choices=parametric_fields,
+                           help="Field to group builds by (can specify multiple, default: %s)"
+                           % ','.join(default_group_fields))
+  agg_options.add_argument("--percentile", dest="percents", type=float, action="append",
+                           help="Percentile to report for each group (can specify multiple, "\
+                           "default: %s)" % ','.join(["%g" % p for p in default_percents]))
+  agg_options.add_argument("--agg-field", dest="agg_field",
+                           help="Numeric field holding a build result to aggregate on the "\
+                           "server, without it builds are pulled and summarised locally")
 
   # output options
   output_options = parser.add_argument_group('Output Options')
   output_options.add_argument("--format", help="Output format", choices=formatters.keys(),
                               default="csv")
   output_options.add_argument("--output", help="File prefix to dump output to")
-  output_options.add_argument("--dump", help="Dump raw ES results to stdout",
-                              action="store_true")
+  output_options.add_argument("--db", metavar="FILE",
+                              help="Upsert component and build results into a SQLite "\
+                              "database, see querydb.py (writes from concurrent "\
+                              "manifest jobs run one at a time)")
+  output_options.add_argument("--dump", metavar="FILE",
+                              help="Also write the raw hits to FILE as newline delimited "\
+                              "JSON, gzipped if FILE ends in .gz")
   output_options.add_argument("--analyser", dest="analysers",
                               help="Analyser to use for summarization (can specify multiple)",
                               choices=analyser_classes.keys(), action="append")
@@ -258,13 +885,20 @@ def cli():
   options = parser.parse_args()
 
   request = {"es_server":options.es_server,
-             "dump":options.dump,
              "all":options.all,
              "size":options.size,
              "format":options.format,
              "analysers":options.analysers or ['build'],
              "index":options.index,
              "batch":options.batch,
+             "pipeline":options.pipeline,
+             "retries":options.retries,
+             "sync":options.sync,
+             "aggregate":options.aggregate,
+             "vectorize":options.vectorize,
+             "processes":options.processes,
+             "flush":options.flush,
+             "log_workers":options.log_workers,
              }
 
   if options.from_date:
@@ -289,8 +923,32 @@ def cli():
     request.update({"starttime":options.starttime})
   if options.machine:
     request.update({"machine":options.machine})
-
-  request_data(request)
+  if options.scroll:
+    request.update({"scroll":options.scroll})
+  if options.timeout:
+    request.update({"timeout":options.timeout})
+  if options.log_cache:
+    request.update({"log_cache":options.log_cache})
+  if options.store:
+    request.update({"store":options.store})
+  if options.dump:
+    request.update({"dump":options.dump})
+  if options.db:
+    request.update({"db":options.db})
+  if options.replay:
+    request.update({"replay":options.replay})
+  if options.group_by:
+    request.update({"group_by":options.group_by})
+  if options.percents:
+    request.update({"percents":options.percents})
+  if options.agg_field:
+    request.update({"agg_field":options.agg_field})
+
+  if options.manifest:
+    request.update({"manifest":options.manifest, "workers":options.workers})
+    run_manifest(request)
+  else:
+    request_data(request)
 
 if __name__ == "__main__":
   cli()
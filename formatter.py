@@ -35,9 +35,15 @@
 # ***** END LICENSE BLOCK *****
 
 import json
+import os
 import sys
+import sqlite3
+import threading
 
-__all__ = ['JsonFormatter', 'CSVFormatter', 'BaseOutput', 'FileOutput']
+from columns import ColumnBuffer
+
+__all__ = ['JsonFormatter', 'CSVFormatter', 'BaseOutput', 'FileOutput', 'SQLiteOutput',
+           'sqlite_tables']
 
 class BaseFormatter(object):
   def __init__(self, headers):
@@ -54,6 +60,8 @@ class JsonFormatter(BaseFormatter):
     BaseFormatter.__init__(self, **kwargs)
 
   def output_records(self, records, output):
+    if isinstance(records, ColumnBuffer):
+      records = records.records()
     output.write("%s\n" % json.dumps(records))
 
   def get_suffix(self):
@@ -63,6 +71,7 @@ class CSVFormatter(BaseFormatter):
   def __init__(self, **kwargs):
     BaseFormatter.__init__(self, **kwargs)
     self.formatter = "%(" + ")s,%(".join(self.headers) + ")s\n"
+    self.row_formatter = ",".join(["%s"] * len(self.headers)) + "\n"
 
   def fill_record(self, record):
     for header in self.headers:
@@ -70,6 +79,10 @@ class CSVFormatter(BaseFormatter):
         record[header] = "NA"
 
   def output_records(self, records, output):
+    if isinstance(records, ColumnBuffer):
+      for row in records.rows(self.headers, "NA"):
+        output.write(self.row_formatter % row)
+      return
     for record in records:
       self.fill_record(record)
       output.write(self.formatter % record)
@@ -90,12 +103,74 @@ class BaseOutput(object):
     self.formatter.output_header(self.output)
 
   def output_records(self):
-    self.formatter.output_records(self.analyser.get_results(), self.output)
+    self.write_records(self.analyser.get_results())
     self.analyser.flush()
 
+  def write_records(self, records):
+    self.formatter.output_records(records, self.output)
+
   def close(self):
     pass
 
+# key and index columns of the tables SQLiteOutput can write, by analyser suffix
+sqlite_tables = {
+    'components' : (['revision', 'machine', 'starttime', 'test_name'],
+                    ['testsuite', 'os', 'test_name', 'starttime']),
+    'builds' : (['revision', 'machine', 'starttime', 'testsuite'],
+                ['testsuite', 'os', 'starttime']),
+}
+
+# seconds a writer waits for another process's lock on the database
+sqlite_timeout = 60
+
+sqlite_locks = {}
+sqlite_locks_lock = threading.Lock()
+
+def sqlite_lock(path):
+  """ The lock serialising this process's writes to the database at path """
+  with sqlite_locks_lock:
+    if path not in sqlite_locks:
+      sqlite_locks[path] = threading.Lock()
+    return sqlite_locks[path]
+
+class SQLiteOutput(BaseOutput):
+  """ Upserts an analyser's results into a table of a SQLite database
+
+      The table is named after the analyser's suffix and keyed so that
+      pulling the same builds again replaces their rows.  SQLite allows one
+      writer at a time, so writes to a database from concurrent manifest
+      jobs take turns, and other processes are waited on for sqlite_timeout.
+  """
+  def __init__(self, path, analyser, headers):
+    BaseOutput.__init__(self, analyser, None)
+    self.table = analyser.get_suffix()
+    self.headers = headers
+    (self.key, self.index) = sqlite_tables[self.table]
+    self.lock = sqlite_lock(os.path.abspath(path))
+    self.conn = sqlite3.connect(path, timeout=sqlite_timeout)
+
+  def output_header(self):
+    with self.lock:
+      self.conn.execute("CREATE TABLE IF NOT EXISTS %s (%s, PRIMARY KEY (%s))" %
+                        (self.table, ', '.join(self.headers), ', '.join(self.key)))
+      self.conn.execute("CREATE INDEX IF NOT EXISTS %s_lookup ON %s (%s)" %
+                        (self.table, self.table, ', '.join(self.index)))
+      self.conn.commit()
+
+  def write_records(self, records):
+    if isinstance(records, ColumnBuffer):
+      rows = records.rows(self.headers)
+    else:
+      rows = [tuple([record.get(header) for header in self.headers]) for record in records]
+    with self.lock:
+      self.conn.executemany("INSERT OR REPLACE INTO %s (%s) VALUES (%s)" %
+                            (self.table, ', '.join(self.headers),
+                             ', '.join(['?'] * len(self.headers))), rows)
+      self.conn.commit()
+
+  def close(self):
+    self.conn.close()
+
 class FileOutput(BaseOutput):
   def __init__(self, output, *pargs):
     BaseOutput.__init__(self, *pargs)
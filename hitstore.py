@@ -0,0 +1,143 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is espull, a log extractor for talos logs stored in ES.
+#
+# The Initial Developer of the Original Code is
+# Stephen Lewchuk (slewchuk@mozilla.com).
+# Portions created by the Initial Developer are Copyright (C) 2011
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+import os
+import json
+import hashlib
+from gzip import GzipFile
+
+__all__ = ['HitStore', 'open_hits', 'read_hits', 'write_hits']
+
+def open_hits(path, mode='rb'):
+  """ Opens a file of newline delimited hits, gzipped if it ends in .gz """
+  if path.endswith('.gz'):
+    return GzipFile(path, mode)
+  return open(path, mode)
+
+def read_hits(path):
+  """ Yields the hits in a file one line at a time """
+  fp = open_hits(path)
+  try:
+    for line in fp:
+      if line.strip():
+        yield json.loads(line)
+  finally:
+    fp.close()
+
+def write_hits(fp, hits):
+  for hit in hits:
+    fp.write("%s\n" % json.dumps(hit))
+
+class HitStore(object):
+  """ An on disk store of raw hits for one index and set of filters
+
+      Hits are appended in segments, one per fetched batch.  Segments are
+      written to a temporary file and renamed into place before the metadata
+      is updated, so an interrupted sync loses at most the batch in flight.
+      The metadata tracks the latest starttime stored and the ids of the hits
+      at that starttime so a sync can pick up where the last one stopped.
+  """
+
+  def __init__(self, root, index, filters):
+    self.index = index
+    self.filters = filters
+    key = json.dumps({'index' : index, 'filters' : filters}, sort_keys=True)
+    self.path = os.path.join(root, hashlib.sha1(key).hexdigest())
+    if not os.path.isdir(self.path):
+      os.makedirs(self.path)
+
+    self.meta_file = os.path.join(self.path, "meta.json")
+    if os.path.exists(self.meta_file):
+      meta_fp = open(self.meta_file)
+      self.meta = json.load(meta_fp)
+      meta_fp.close()
+    else:
+      self.meta = {'index' : index,
+                   'filters' : filters,
+                   'segments' : [],
+                   'last_starttime' : None,
+                   'last_ids' : [],
+                  }
+
+  def __len__(self):
+    return sum([count for (_, count) in self.meta['segments']])
+
+  def get_last_starttime(self):
+    return self.meta['last_starttime']
+
+  def is_stored(self, hit):
+    """ Whether a hit at the latest starttime has already been stored """
+    return (hit['_source'].get('starttime') == self.meta['last_starttime'] and
+            hit['_id'] in self.meta['last_ids'])
+
+  def _write_meta(self):
+    tmp_file = self.meta_file + ".tmp"
+    meta_fp = open(tmp_file, 'w')
+    json.dump(self.meta, meta_fp)
+    meta_fp.close()
+    os.rename(tmp_file, self.meta_file)
+
+  def append(self, hits):
+    """ Adds a batch of hits, which must be sorted by starttime """
+    hits = [hit for hit in hits if not self.is_stored(hit)]
+    if not hits:
+      return 0
+
+    name = "%06d.json.gz" % len(self.meta['segments'])
+    seg_file = os.path.join(self.path, name)
+    tmp_file = os.path.join(self.path, "tmp-" + name)
+    seg_fp = open_hits(tmp_file, 'wb')
+    write_hits(seg_fp, hits)
+    seg_fp.close()
+    os.rename(tmp_file, seg_file)
+
+    last_starttime = hits[-1]['_source'].get('starttime')
+    if last_starttime != self.meta['last_starttime']:
+      self.meta['last_starttime'] = last_starttime
+      self.meta['last_ids'] = []
+    for hit in hits:
+      if hit['_source'].get('starttime') == last_starttime:
+        self.meta['last_ids'].append(hit['_id'])
+
+    self.meta['segments'].append((name, len(hits)))
+    self._write_meta()
+    return len(hits)
+
+  def read(self):
+    """ Yields every stored hit in the order it was stored """
+    for (name, _) in self.meta['segments']:
+      for hit in read_hits(os.path.join(self.path, name)):
+        yield hit
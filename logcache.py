@@ -0,0 +1,185 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is espull, a log extractor for talos logs stored in ES.
+#
+# The Initial Developer of the Original Code is
+# Stephen Lewchuk (slewchuk@mozilla.com).
+# Portions created by the Initial Developer are Copyright (C) 2011
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+import os
+import zlib
+import hashlib
+import tempfile
+import urllib2
+from gzip import GzipFile
+
+__all__ = ['LogCache', 'GzipLineReader', 'open_log']
+
+class CacheWriter(object):
+  """ Copies a download into a temporary file, moved into the cache once complete """
+  def __init__(self, path):
+    self.path = path
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        # another download made it first
+        pass
+    (fd, self.tmp_path) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    self.fp = os.fdopen(fd, 'wb')
+
+  def write(self, data):
+    self.fp.write(data)
+
+  def commit(self):
+    self.fp.close()
+    os.rename(self.tmp_path, self.path)
+
+  def abort(self):
+    self.fp.close()
+    os.remove(self.tmp_path)
+
+class LogCache(object):
+  """ An on disk cache of downloaded gzipped logs addressed by the sha1 of their url """
+  def __init__(self, root):
+    self.root = root
+
+  def path(self, url):
+    key = hashlib.sha1(url).hexdigest()
+    return os.path.join(self.root, key[:2], key + ".gz")
+
+  def get(self, url):
+    path = self.path(url)
+    if os.path.exists(path):
+      return path
+    return None
+
+  def writer(self, url):
+    return CacheWriter(self.path(url))
+
+def _stream_ended(decompressor):
+  """ Whether a decompressor has read the whole of its gzip member
+
+      Python 2's zlib has no eof flag, but once the trailer has been read any
+      further input is left in unused_data rather than consumed.
+  """
+  probe = decompressor.copy()
+  try:
+    probe.decompress("\0")
+  except zlib.error:
+    return False
+  return probe.unused_data != ""
+
+class GzipLineReader(object):
+  """ Decompresses a gzip stream as it is read, one line at a time
+
+      Unlike GzipFile this never seeks, so it can read straight from a
+      download.  The compressed data can be copied to a CacheWriter as it
+      goes, which is committed once the end of the stream is reached.  A
+      download which stops short of the gzip trailer raises IOError and is
+      left out of the cache.
+  """
+
+  chunk_size = 65536
+
+  def __init__(self, fp, copy=None):
+    self.fp = fp
+    self.copy = copy
+    self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    self.buffer = ""
+    self.pos = 0
+    self.done = False
+
+  def _fill(self):
+    raw = self.fp.read(self.chunk_size)
+    data = []
+    if raw:
+      if self.copy is not None:
+        self.copy.write(raw)
+      data.append(self.decompressor.decompress(raw))
+      # logs may be several gzip members concatenated
+      while self.decompressor.unused_data:
+        unused = self.decompressor.unused_data
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data.append(self.decompressor.decompress(unused))
+    else:
+      if not _stream_ended(self.decompressor):
+        if self.copy is not None:
+          self.copy.abort()
+          self.copy = None
+        raise IOError("Log download ended before the end of its gzip stream")
+      data.append(self.decompressor.flush())
+      self.done = True
+      if self.copy is not None:
+        self.copy.commit()
+        self.copy = None
+    self.buffer = self.buffer[self.pos:] + "".join(data)
+    self.pos = 0
+
+  def readline(self):
+    while True:
+      end = self.buffer.find("\n", self.pos)
+      if end >= 0:
+        line = self.buffer[self.pos:end + 1]
+        self.pos = end + 1
+        return line
+      if self.done:
+        line = self.buffer[self.pos:]
+        self.pos = len(self.buffer)
+        return line
+      self._fill()
+
+  def __iter__(self):
+    return iter(self.readline, "")
+
+  def close(self):
+    self.fp.close()
+    if self.copy is not None:
+      self.copy.abort()
+      self.copy = None
+
+def open_log(url, cache=None):
+  """ Opens a gzipped log for reading line by line
+
+      Cached logs are read from disk, others are decompressed as they
+      download and added to the cache when the whole log has been read.
+  """
+  if cache is not None:
+    path = cache.get(url)
+    if path is not None:
+      return GzipFile(path)
+
+  conn = urllib2.urlopen(url)
+  copy = None
+  if cache is not None:
+    copy = cache.writer(url)
+  return GzipLineReader(conn, copy)
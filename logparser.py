@@ -38,18 +38,104 @@ from gzip import GzipFile
 import re
 import argparse
 import os
+import sys
+import json
+import mmap
+import zlib
+import multiprocessing
 
-class CorruptParser(object):
-  talosTestRe = re.compile(r"^Running test (.*?):$")
-  corruptRe = re.compile(r"^Corrupt JPEG.*$")
-  pageloadRe = re.compile(r"^.*NOISE: Cycle (\d*?): loaded (\S*?) .*$")
-  talosEndTestRe = re.compile(r"^Completed test (.*?):$")
+talosTestRe = re.compile(r"^Running test (.*?):$")
+talosEndTestRe = re.compile(r"^Completed test (.*?):$")
+corruptRe = re.compile(r"^Corrupt JPEG.*$")
+pageloadRe = re.compile(r"^.*NOISE: Cycle (\d*?): loaded (\S*?) .*$")
+
+class Extractor(object):
+  """ A base class for pulling results out of the lines of talos tests in a log
+
+      The LogParser tells each extractor when a test starts and ends, and
+      hands it every line in between.
+  """
+  def __init__(self):
+    self.results = []
+
+  def start_test(self, test_name, linenumber):
+    pass
+
+  def line(self, test_name, line, linenumber):
+    pass
+
+  def end_test(self, test_name, linenumber):
+    pass
+
+class CorruptExtractor(Extractor):
+  """ (test, cycle, page) for each page load following a Corrupt JPEG message """
+  def __init__(self):
+    Extractor.__init__(self)
+    self.seen_corrupt = False
+
+  def line(self, test_name, line, linenumber):
+    m = corruptRe.match(line)
+    if m:
+      self.seen_corrupt = True
+      return
+    if self.seen_corrupt:
+      m = pageloadRe.match(line)
+      if m:
+        self.results.append((test_name, m.group(1), m.group(2)))
+      self.seen_corrupt = False
 
+class PageloadExtractor(Extractor):
+  """ (test, cycle, page, load index) for each NOISE page load line
+
+      The load index counts the page loads within the cycle.
+  """
+  def __init__(self):
+    Extractor.__init__(self)
+    self.cycle = None
+    self.load_index = 0
+
+  def start_test(self, test_name, linenumber):
+    self.cycle = None
+
+  def line(self, test_name, line, linenumber):
+    if "NOISE" not in line:
+      return
+    m = pageloadRe.match(line)
+    if m:
+      if m.group(1) != self.cycle:
+        self.cycle = m.group(1)
+        self.load_index = 0
+      self.results.append((test_name, m.group(1), m.group(2), self.load_index))
+      self.load_index += 1
+
+class TestExtractor(Extractor):
+  """ (test, start line, end line, page loads) for each test run in the log
+
+      Talos lines carry no timestamps, so a test's extent is measured in log
+      lines.  Tests which never complete have an end line of None.
+  """
   def __init__(self):
+    Extractor.__init__(self)
+    self.current = None
+
+  def start_test(self, test_name, linenumber):
+    self.current = [test_name, linenumber, None, 0]
+    self.results.append(self.current)
+
+  def line(self, test_name, line, linenumber):
+    if "NOISE" in line and pageloadRe.match(line):
+      self.current[3] += 1
+
+  def end_test(self, test_name, linenumber):
+    self.current[2] = linenumber
+
+class LogParser(object):
+  """ Runs several extractors over a log in a single pass """
+
+  def __init__(self, extractors):
+    self.extractors = extractors
     self.linenumber = 0
-    self.corrupt_pages = []
     self.in_test = False
-    self.seen_corrupt = False
     self.test_name = ""
 
   def parse(self, fp):
@@ -61,29 +147,120 @@ class CorruptParser(object):
       line = line.rstrip()
 
       if self.in_test:
-        m = self.talosEndTestRe.match(line)
+        m = talosEndTestRe.match(line)
         if m:
+          for extractor in self.extractors:
+            extractor.end_test(self.test_name, self.linenumber)
           self.in_test = False
           self.test_name = ""
           continue
-        m = self.corruptRe.match(line)
-        if m:
-          self.seen_corrupt = True
-          continue
-        if self.seen_corrupt:
-          m = self.pageloadRe.match(line)
-          if m:
-            self.corrupt_pages.append((self.test_name, m.group(1), m.group(2)))
-          self.seen_corrupt = False
-          continue
+        for extractor in self.extractors:
+          extractor.line(self.test_name, line, self.linenumber)
       else:
-        m = self.talosTestRe.match(line)
+        m = talosTestRe.match(line)
         if m:
           self.in_test = True
           self.test_name = m.group(1)
+          for extractor in self.extractors:
+            extractor.start_test(self.test_name, self.linenumber)
           continue
 
-    return (self.corrupt_pages, self.linenumber)
+    return self.linenumber
+
+class CorruptParser(object):
+  talosTestRe = talosTestRe
+  corruptRe = corruptRe
+  pageloadRe = pageloadRe
+  talosEndTestRe = talosEndTestRe
+
+  def parse(self, fp):
+    extractor = CorruptExtractor()
+    linenumber = LogParser([extractor]).parse(fp)
+    return (extractor.results, linenumber)
+
+corrupt_marker = "Corrupt JPEG"
+
+def is_gzip(log):
+  fp = open(log, "rb")
+  magic = fp.read(2)
+  fp.close()
+  return magic == "\x1f\x8b"
+
+def gzip_contains(log, marker, chunk_size=1 << 20):
+  """ Whether a gzipped file contains marker, decompressing in chunks """
+  decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  fp = open(log, "rb")
+  try:
+    tail = ""
+    while True:
+      raw = fp.read(chunk_size)
+      if not raw:
+        return False
+      data = tail + decompressor.decompress(raw)
+      while decompressor.unused_data:
+        unused = decompressor.unused_data
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data += decompressor.decompress(unused)
+      if data.find(marker) >= 0:
+        return True
+      # keep enough to catch a marker split across chunks
+      tail = data[-(len(marker) - 1):]
+  finally:
+    fp.close()
+
+def scan_file(log):
+  """ Parses a log for corrupt pages, skipping logs without a corrupt message
+
+      Returns (log, corrupt pages, error).  Plain logs are memory mapped and
+      searched for the marker in place, gzipped logs are decompressed in
+      chunks to search and only decompressed again to parse if it is found.
+  """
+  try:
+    if is_gzip(log):
+      if not gzip_contains(log, corrupt_marker):
+        return (log, [], None)
+      fp = GzipFile(log)
+    else:
+      if os.path.getsize(log) == 0:
+        return (log, [], None)
+      f = open(log, "rb")
+      fp = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      f.close()
+      if fp.find(corrupt_marker) < 0:
+        fp.close()
+        return (log, [], None)
+
+    try:
+      (results, _) = CorruptParser().parse(fp)
+    finally:
+      fp.close()
+    return (log, results, None)
+  except (IOError, zlib.error), e:
+    return (log, [], str(e))
+
+def scan_files(logs, workers, output):
+  """ Scans many logs on a pool of processes and writes one JSON summary """
+  pool = multiprocessing.Pool(workers)
+  corrupt = {}
+  errors = {}
+  scanned = 0
+  for (log, results, error) in pool.imap_unordered(scan_file, logs, 16):
+    scanned += 1
+    if error is not None:
+      errors[log] = error
+    elif results:
+      corrupt[log] = results
+  pool.close()
+  pool.join()
+
+  summary = {'scanned' : scanned,
+             'corrupt_files' : len(corrupt),
+             'corrupt_pages' : sum([len(results) for results in corrupt.values()]),
+             'files' : corrupt,
+             'errors' : errors,
+            }
+  json.dump(summary, output, sort_keys=True, indent=1)
+  output.write("\n")
 
 def parse_file(log):
     print log
@@ -103,12 +280,29 @@ if __name__ == "__main__":
   parser.add_argument('files', metavar='files', nargs='+',
                      help='a file to parse')
   parser.add_argument('--dir', dest="dir", action="store_true")
+  parser.add_argument('--scan', action="store_true",
+                      help='scan the files in parallel and output a single JSON summary')
+  parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                      help='number of processes to scan with')
+  parser.add_argument('--output', help='file to write the --scan summary to')
   args = parser.parse_args()
 
+  logs = []
   for f in args.files:
     if args.dir:
       for l in os.listdir(f):
-        parse_file(os.path.join(f,l))
+        logs.append(os.path.join(f,l))
+    else:
+      logs.append(f)
+
+  if args.scan:
+    if args.output:
+      output = open(args.output, 'w')
+      scan_files(logs, args.workers, output)
+      output.close()
     else:
-      parse_file(f)
+      scan_files(logs, args.workers, sys.stdout)
+  else:
+    for log in logs:
+      parse_file(log)
 
@@ -0,0 +1,111 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is espull, a log extractor for talos logs stored in ES.
+#
+# The Initial Developer of the Original Code is
+# Stephen Lewchuk (slewchuk@mozilla.com).
+# Portions created by the Initial Developer are Copyright (C) 2011
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+import sys
+import sqlite3
+import argparse
+import calendar
+import time
+
+from formatter import JsonFormatter, CSVFormatter, sqlite_tables
+
+__all__ = ['query_rows']
+
+formatters = {"json" : JsonFormatter, "csv" : CSVFormatter}
+
+def parse_time(value):
+  """ Accepts either seconds since the epoch or a YYYY-MM-DD date in UTC """
+  if value.isdigit():
+    return int(value)
+  return calendar.timegm(time.strptime(value, "%Y-%m-%d"))
+
+def query_rows(path, table, filters, start=None, end=None):
+  """ Returns the headers and rows of a table written with espull --db
+
+      filters maps columns to the values they must equal, start and end
+      bound the starttime of the rows returned.
+  """
+  conn = sqlite3.connect(path)
+  headers = [column[1] for column in conn.execute("PRAGMA table_info(%s)" % table)]
+
+  clauses = []
+  params = []
+  for (column, value) in filters:
+    clauses.append("%s = ?" % column)
+    params.append(value)
+  if start is not None:
+    clauses.append("starttime >= ?")
+    params.append(start)
+  if end is not None:
+    clauses.append("starttime < ?")
+    params.append(end)
+
+  query = "SELECT %s FROM %s" % (', '.join(headers), table)
+  if clauses:
+    query += " WHERE " + " AND ".join(clauses)
+  query += " ORDER BY starttime"
+
+  rows = conn.execute(query, params).fetchall()
+  conn.close()
+  return (headers, rows)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Query results stored with espull --db')
+  parser.add_argument('db', help='the SQLite database to query')
+  parser.add_argument('--table', default='components', choices=sorted(sqlite_tables.keys()))
+  parser.add_argument('--testsuite')
+  parser.add_argument('--os')
+  parser.add_argument('--test-name', dest='test_name')
+  parser.add_argument('--machine')
+  parser.add_argument('--revision')
+  parser.add_argument('--from', dest='start', type=parse_time,
+                      help='earliest starttime, epoch seconds or YYYY-MM-DD')
+  parser.add_argument('--to', dest='end', type=parse_time,
+                      help='starttime to stop before, epoch seconds or YYYY-MM-DD')
+  parser.add_argument('--format', default='csv', choices=sorted(formatters.keys()))
+  args = parser.parse_args()
+
+  filters = []
+  for column in ['testsuite', 'os', 'test_name', 'machine', 'revision']:
+    value = getattr(args, column)
+    if value is not None:
+      filters.append((column, value))
+
+  (headers, rows) = query_rows(args.db, args.table, filters, args.start, args.end)
+  formatter = formatters[args.format](headers=headers)
+  formatter.output_header(sys.stdout)
+  records = [dict([(h, v) for (h, v) in zip(headers, row) if v is not None]) for row in rows]
+  formatter.output_records(records, sys.stdout)
@@ -6,7 +6,7 @@ fi
 if [ ! -d $1 ]; then
   mkdir $1
 fi
-common="--es-server=elasticsearch1.metrics.sjc1.mozilla.com:9200 --all --analyser=comp --analyser=build --analyser=run"
+common="--es-server=elasticsearch1.metrics.sjc1.mozilla.com:9200 --all --scroll=5m --analyser=comp --analyser=build --analyser=run"
 dates=""
 if [ ! -z $2 ]; then
   if [ ! -z $3 ]; then
@@ -14,27 +14,17 @@ if [ ! -z $2 ]; then
   fi
 fi
 
-testsuites=("tdhtml" "tdhtml" "tp5" "tsspider" "tsspider" "tsvg")
-testgroups=("chrome" "nochrome" "" "chrome" "nochrome" "")
-extra_testgroup=("chrome_mac" "" "" "chrome_mac" "" "")
-
-for i in {0..5}; do
-  ts=${testsuites[$i]}
-  tg=${testgroups[$i]}
-  tg_e=${extra_testgroup[$i]}
-  output="$ts"
-  params=""
-  if [ ! -z $tg ]; then
-    output="$ts-$tg"
-    if [ ! -z $tg_e ]; then
-      tg="$tg|$tg_e"
-    fi
-    params="--testgroup=$tg"
-  fi
-  echo $ts $tg $1/$output
-  if [ ! -d $1/$output ]; then
-    mkdir $1/$output
-  fi
-  python espull.py $common $dates $params --testsuite=$ts --output=$1/$output/$output
-done;
+# espull merges the chrome/nochrome variants of a testsuite into one query
+manifest=$1/manifest.json
+cat > $manifest <<MANIFEST
+{"jobs": [
+  {"testsuite": "tdhtml", "testgroup": "chrome|chrome_mac", "output": "$1/tdhtml-chrome/tdhtml-chrome"},
+  {"testsuite": "tdhtml", "testgroup": "nochrome", "output": "$1/tdhtml-nochrome/tdhtml-nochrome"},
+  {"testsuite": "tp5", "output": "$1/tp5/tp5"},
+  {"testsuite": "tsspider", "testgroup": "chrome|chrome_mac", "output": "$1/tsspider-chrome/tsspider-chrome"},
+  {"testsuite": "tsspider", "testgroup": "nochrome", "output": "$1/tsspider-nochrome/tsspider-nochrome"},
+  {"testsuite": "tsvg", "output": "$1/tsvg/tsvg"}
+]}
+MANIFEST
 
+python espull.py $common $dates --manifest=$manifest --workers=4
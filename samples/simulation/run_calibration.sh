@@ -6,6 +6,7 @@ echo "WARNING: This may take upward of 40 minutes to complete all the simulation
 
 R -f --no-restore --slave --no-save generate_samples.r
 
-python ../../simulate.py samples/*.dat calibration --max_sample=30 --calibrate 20
+# the fixed seed lets an interrupted run resume from the cache
+python ../../simulate.py samples/*.dat calibration --max_sample=30 --calibrate 20 --seed=1 --cache=cache
 
 R -f --no-restore --slave --no-save calibrate_tests.r
@@ -0,0 +1,143 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is espull, a log extractor for talos logs stored in ES.
+#
+# The Initial Developer of the Original Code is
+# Stephen Lewchuk (slewchuk@mozilla.com).
+# Portions created by the Initial Developer are Copyright (C) 2011
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from gzip import GzipFile
+
+from logcache import CacheWriter
+
+__all__ = ['ResultCache', 'unit_key']
+
+def unit_key(unit):
+  """ The sha1 addressing a unit of work described by a JSON serializable dict """
+  return hashlib.sha1(json.dumps(unit, sort_keys=True)).hexdigest()
+
+class ResultCache(object):
+  """ An on disk cache of simulation results addressed by the key of their unit
+
+      Each entry is a gzipped JSON document holding the unit's description
+      and its results.  Reading an entry touches it, so the modification time
+      records when it was last used.
+  """
+  def __init__(self, root):
+    self.root = root
+
+  def path(self, key):
+    return os.path.join(self.root, key[:2], key + ".json.gz")
+
+  def get(self, key):
+    path = self.path(key)
+    if not os.path.exists(path):
+      return None
+    fp = GzipFile(path)
+    try:
+      entry = json.load(fp)
+    finally:
+      fp.close()
+    os.utime(path, None)
+    return entry['results']
+
+  def put(self, key, unit, results):
+    writer = CacheWriter(self.path(key))
+    fp = GzipFile(fileobj=writer, mode='wb')
+    try:
+      json.dump({'unit' : unit, 'results' : results}, fp)
+      fp.close()
+    except:
+      fp.close()
+      writer.abort()
+      raise
+    writer.commit()
+
+  def entries(self):
+    """ Yields the key, path, unit and last used time of every entry """
+    if not os.path.isdir(self.root):
+      return
+    for prefix in sorted(os.listdir(self.root)):
+      directory = os.path.join(self.root, prefix)
+      if not os.path.isdir(directory):
+        continue
+      for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json.gz"):
+          continue
+        path = os.path.join(directory, name)
+        fp = GzipFile(path)
+        try:
+          unit = json.load(fp)['unit']
+        finally:
+          fp.close()
+        yield (name[:-len(".json.gz")], path, unit, os.path.getmtime(path))
+
+  def evict(self, older_than=None, test_name=None):
+    """ Removes entries unused for older_than seconds and/or of a test, returning the count """
+    now = time.time()
+    removed = 0
+    for (key, path, unit, used) in list(self.entries()):
+      if older_than is not None and now - used < older_than:
+        continue
+      if test_name is not None and unit.get('test_name') != test_name:
+        continue
+      os.remove(path)
+      removed += 1
+    return removed
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='List or evict cached simulate.py results')
+  parser.add_argument('cache', help='the --cache directory of simulate.py')
+  parser.add_argument('command', choices=['list', 'evict'])
+  parser.add_argument('--older-than', dest='older_than', type=float,
+                      help='only entries unused for this many days')
+  parser.add_argument('--test', dest='test_name', help='only entries of this test')
+  args = parser.parse_args()
+
+  cache = ResultCache(args.cache)
+  if args.command == 'list':
+    for (key, path, unit, used) in cache.entries():
+      print "%s %s %s %s" % (key, time.strftime("%Y-%m-%d %H:%M", time.localtime(used)),
+                             unit.get('test_name'), json.dumps(unit, sort_keys=True))
+  else:
+    if args.older_than is None and args.test_name is None:
+      print "evict needs --older-than or --test"
+      sys.exit(1)
+    older_than = None
+    if args.older_than is not None:
+      older_than = args.older_than * 24 * 60 * 60
+    print "Evicted %d entries" % cache.evict(older_than, args.test_name)
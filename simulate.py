@@ -37,12 +37,30 @@
 import argparse
 import random
 import os.path
+import hashlib
+import heapq
+import math
+import multiprocessing
 from datetime import datetime
 
 from statlib import stats
 
 from formatter import *
 from analyser import get_median, get_average
+from simcache import ResultCache, unit_key
+import vectorized
+
+# columns of each output, results passed between processes don't keep their key order
+output_headers = {
+    'rev' : ['test_name', 'sample_size', 'index', 'mean', 'median'],
+    'conf' : ['test_name', 'sample_size', 'index', 'same', 'same_stat', 'less', 'less_stat',
+              'more', 'more_stat'],
+    'detect' : ['test_name', 'sample_size', 'same_ratio', 'less_ratio', 'more_ratio'],
+    'hist' : ['test_name', 'sample_size', 'test', 'bin', 'count'],
+}
+
+# bins of the histograms of each test's probabilities
+histogram_bins = 20
 
 class Simulation(object):
   """ This class runs a sample size simulation based on a set of observations
@@ -53,16 +71,27 @@ class Simulation(object):
         source_data -- a list of observed values to sample from
         sample_size -- the sample size to use for the simulation
         threshold -- the magnitude of change to try and detect
+        seed -- seeds the simulation's own random stream, None for a random seed
+        width -- if given, stop once the 95% Wilson intervals of all the detection
+                 ratios are narrower than this, running at most repetitions
 
       Output:
         Once the simulation is complete three pieces of data is produced:
           rev_results - the mean and median of each sample taken
           conf_results - the a set of probabilities of the sample compared to different values
           simulation_result - the ratios of detection for this sample size
+        Given a sink with set_sink, rev and conf results are passed to it as
+        they are produced instead of being kept.  A histogram of each test's
+        probabilities is always kept.
   """
 
-  def __init__(self, source_data, sample_size, test_name, threshold=0.01):
+  # repetitions run between convergence checks when a width is given
+  adaptive_batch = 100
+
+  def __init__(self, source_data, sample_size, test_name, threshold=0.01, seed=None, width=None):
     self.data = source_data
+    self.rand = random.Random(seed)
+    self.width = width
     self.popmean = stats.mean(source_data)
     self.sample_size = sample_size
     self.rev_results = []
@@ -72,23 +101,50 @@ class Simulation(object):
     self.index = 0
     self.test_name = test_name
     self.template = {'sample_size' : self.sample_size, 'test_name' : self.test_name }
+    # [passed, valid] counts of each test
+    self.counts = {'same' : [0, 0], 'less' : [0, 0], 'more' : [0, 0]}
+    self.histograms = {'same' : [0] * histogram_bins, 'less' : [0] * histogram_bins,
+                       'more' : [0] * histogram_bins}
+    self.sink = None
+
+  def set_sink(self, sink):
+    """ Passes each rev and conf result to sink(key, result) rather than keeping it """
+    self.sink = sink
+
+  def test_means(self):
+    """ The population means the samples are tested against: same, less and more """
+    return [self.popmean,
+            min(int(self.popmean * (1-self.threshold)), self.popmean - 1),
+            max(int(self.popmean * (1+self.threshold)), self.popmean + 1)]
 
   def analyse_sample_set(self, samples):
     """ Analyses a set of sample of length sample_size """
+    if len(set(samples)) == 1:
+      t_probs = [-1, -1, -1]
+    else:
+      t_probs = [stats.ttest_1samp(samples, popmean)[1] for popmean in self.test_means()]
+    self.record_sample(get_average(samples)[0], get_median(samples), *t_probs)
+
+  def analyse_sums(self, total, squares, median):
+    """ Analyses a sample from its sum, sum of squares and median """
+    if self.sample_size * squares == total * total:
+      t_probs = [-1, -1, -1]
+    else:
+      t_probs = [ttest_1samp_sums(self.sample_size, total, squares, popmean)
+                 for popmean in self.test_means()]
+    self.record_sample(total / self.sample_size, median, *t_probs)
+
+  def record_sample(self, mean, median, t_prob1, t_prob2, t_prob3):
+    """ Adds the rev and conf results of one sample """
     result = self.template.copy()
     result.update( { 'index' : self.index,
-                     'mean' : get_average(samples)[0],
-                     'median': get_median(samples),
+                     'mean' : mean,
+                     'median': median,
                    } )
-    self.rev_results.append(result)
-    if len(set(samples)) == 1:
-      t_prob1 = -1
-      t_prob2 = -1
-      t_prob3 = -1
+    if self.sink is None:
+      self.rev_results.append(result)
     else:
-      (t_stat, t_prob1) = stats.ttest_1samp(samples, self.popmean)
-      (t_stat, t_prob2) = stats.ttest_1samp(samples, min(int(self.popmean * (1-self.threshold)), self.popmean - 1))
-      (t_stat, t_prob3) = stats.ttest_1samp(samples, max(int(self.popmean * (1+self.threshold)), self.popmean + 1))
+      self.sink('rev', result)
     result = self.template.copy()
     result.update( { 'index' : self.index,
                      'same' : t_prob1 > 0.05,
@@ -98,34 +154,341 @@ class Simulation(object):
                      'more' : t_prob3 < 0.05,
                      'more_stat' : t_prob3,
                    } )
-    self.conf_results.append(result)
+    if self.sink is None:
+      self.conf_results.append(result)
+    else:
+      self.sink('conf', result)
+    for (name, count) in self.counts.items():
+      prob = result[name + '_stat']
+      if prob != -1:
+        count[0] += result[name]
+        count[1] += 1
+        self.histograms[name][min(int(prob * histogram_bins), histogram_bins - 1)] += 1
+
+  def converged(self):
+    """ Whether the intervals of all the detection ratios are narrower than width """
+    for (passed, valid) in self.counts.values():
+      (low, high) = wilson_interval(passed, valid)
+      if high - low >= self.width:
+        return False
+    return True
 
   def analyse_simulation(self):
     """ Analyse the whole set of samples for this simulation """
-    less_valid = sum([r['less_stat'] != -1 for r in self.conf_results])
-    less_passed = sum([r['less'] for r in self.conf_results if r['less_stat'] != -1])
-    more_valid = sum([r['more_stat'] != -1 for r in self.conf_results])
-    more_passed = sum([r['more'] for r in self.conf_results if r['more_stat'] != -1])
-    same_valid = sum([r['same_stat'] != -1 for r in self.conf_results])
-    same_passed = sum([r['same'] for r in self.conf_results if r['same_stat'] != -1])
+    (less_passed, less_valid) = self.counts['less']
+    (more_passed, more_valid) = self.counts['more']
+    (same_passed, same_valid) = self.counts['same']
     self.simulation_result = self.template.copy()
     self.simulation_result.update( { 'less_ratio' : float(less_passed)/less_valid,
                                      'more_ratio' : float(more_passed)/more_valid,
                                      'same_ratio' : float(same_passed)/same_valid,
                                    } )
 
-  def run_simulation(self, repetitions):
-    """ Runs the simulation repetitions number of times """
-    print "Simulating sample size: %d" % self.sample_size
+  def run_repetitions(self, repetitions):
+    """ Draws and analyses repetitions more samples """
     for i in xrange(repetitions):
       samples = []
       for j in xrange(self.sample_size):
-        sample = random.choice(self.data)
+        sample = self.rand.choice(self.data)
         samples.append(sample)
       self.analyse_sample_set(samples)
       self.index += 1
+
+  def run_simulation(self, repetitions):
+    """ Runs the simulation repetitions number of times, or until converged with a width """
+    print "Simulating sample size: %d" % self.sample_size
+    if self.width is None:
+      self.run_repetitions(repetitions)
+    else:
+      while self.index < repetitions and not self.converged():
+        self.run_repetitions(min(self.adaptive_batch, repetitions - self.index))
+      print "Sample size %d stopped after %d repetitions" % (self.sample_size, self.index)
     self.analyse_simulation()
 
+  def detection_results(self):
+    return [self.simulation_result]
+
+  def histogram_results(self):
+    results = []
+    for name in ['same', 'less', 'more']:
+      for (i, count) in enumerate(self.histograms[name]):
+        result = self.template.copy()
+        result.update( { 'test' : name,
+                         'bin' : float(i) / histogram_bins,
+                         'count' : count,
+                       } )
+        results.append(result)
+    return results
+
+class VectorSimulation(Simulation):
+  """ A Simulation that draws and tests all of its repetitions at once
+
+      The repetitions x sample_size matrix of samples is drawn in one go and
+      the means, medians and t-tests are computed row-wise with numpy, giving
+      the same rev, conf and detect output as Simulation.
+  """
+
+  def __init__(self, source_data, sample_size, test_name, threshold=0.01, seed=None, width=None):
+    Simulation.__init__(self, source_data, sample_size, test_name, threshold, seed, width)
+    self.values = vectorized.numpy.array(self.data)
+    self.rand = vectorized.numpy.random.RandomState(seed)
+
+  def record_sample_matrix(self, samples, probs):
+    """ Records the mean and median of every row of samples with the rows' test probabilities """
+    numpy = vectorized.numpy
+    size = samples.shape[1]
+    # integer samples give the floor division results of get_average and get_median
+    means = vectorized.row_totals(samples) / size
+    ordered = numpy.sort(samples, axis=1)
+    if size % 2 == 1:
+      medians = ordered[:, size/2]
+    else:
+      medians = (ordered[:, size/2 - 1] + ordered[:, size/2]) / 2
+
+    for row in zip(means.tolist(), medians.tolist(), *probs):
+      self.record_sample(*row)
+      self.index += 1
+
+  def analyse_sample_matrix(self, samples):
+    """ Analyses every row of a repetitions x sample_size matrix of samples """
+    numpy = vectorized.numpy
+    constant = samples.min(axis=1) == samples.max(axis=1)
+    probs = []
+    for popmean in self.test_means():
+      (t_stat, t_prob) = vectorized.ttest_1samp(samples.astype(float), popmean)
+      probs.append(numpy.where(constant, -1, t_prob).tolist())
+    self.record_sample_matrix(samples, probs)
+
+  def run_repetitions(self, repetitions):
+    """ Draws and analyses repetitions more samples """
+    draws = self.rand.randint(0, len(self.values), (repetitions, self.sample_size))
+    self.analyse_sample_matrix(self.values[draws])
+
+# two sample tests, taking the baseline and other samples as rows and a RandomState
+two_sample_tests = {
+    'welch' : vectorized.welch_test,
+    'mannwhitney' : vectorized.mann_whitney_test,
+    'bootstrap' : vectorized.bootstrap_test,
+}
+
+class TwoSampleSimulation(VectorSimulation):
+  """ A VectorSimulation comparing a baseline sample against a second sample
+
+      Each repetition draws a baseline and a second sample of sample_size
+      from the data.  same tests the baseline against the second sample as
+      drawn, less and more against the second sample shifted down or up to
+      the less and more means of test_means.  test names the two_sample_tests
+      entry used, run over all of the repetitions at once.  The rev results
+      describe the baseline samples.
+  """
+
+  def __init__(self, source_data, sample_size, test_name, threshold=0.01, seed=None, width=None,
+               test='welch'):
+    VectorSimulation.__init__(self, source_data, sample_size, test_name, threshold, seed, width)
+    self.test = two_sample_tests[test]
+
+  def analyse_sample_pairs(self, baseline, other):
+    """ Analyses every row of the baseline samples against the same row of other """
+    numpy = vectorized.numpy
+    base_values = baseline.astype(float)
+    other_values = other.astype(float)
+    probs = []
+    for popmean in self.test_means():
+      t_prob = self.test(base_values, other_values + (popmean - self.popmean), self.rand)
+      probs.append(numpy.where(numpy.isnan(t_prob), -1, t_prob).tolist())
+    self.record_sample_matrix(baseline, probs)
+
+  def run_repetitions(self, repetitions):
+    """ Draws and analyses repetitions more pairs of samples """
+    shape = (repetitions, self.sample_size)
+    baseline = self.values[self.rand.randint(0, len(self.values), shape)]
+    other = self.values[self.rand.randint(0, len(self.values), shape)]
+    self.analyse_sample_pairs(baseline, other)
+
+class NestedSimulation(object):
+  """ Simulates a range of sample sizes using common random numbers
+
+      Each repetition draws one sample of the largest size and every smaller
+      size is analysed on a prefix of it.  Running sums and a two heap running
+      median mean each extra size costs little more than its t-tests, and as
+      the sizes share their draws the detection ratios vary smoothly between
+      them.  Takes the arguments of Simulation with a list of sample sizes.
+  """
+
+  def __init__(self, source_data, sample_sizes, test_name, threshold=0.01, seed=None, width=None):
+    self.data = source_data
+    self.rand = random.Random(seed)
+    self.width = width
+    self.sample_sizes = sorted(sample_sizes)
+    self.sims = {}
+    for s in self.sample_sizes:
+      self.sims[s] = Simulation(source_data, s, test_name, threshold, width=width)
+    self.rev_results = []
+    self.conf_results = []
+
+  def set_sink(self, sink):
+    for sim in self.sims.values():
+      sim.set_sink(sink)
+
+  def analyse_sample_set(self, samples):
+    """ Analyses every prefix of samples with a simulated size """
+    total = 0
+    squares = 0
+    # the lower half of the sample, negated to make a max heap, and the upper half
+    lower = []
+    upper = []
+    for (size, sample) in enumerate(samples, 1):
+      total += sample
+      squares += sample * sample
+      if not lower or sample <= -lower[0]:
+        heapq.heappush(lower, -sample)
+      else:
+        heapq.heappush(upper, sample)
+      if len(lower) > len(upper) + 1:
+        heapq.heappush(upper, -heapq.heappop(lower))
+      elif len(upper) > len(lower):
+        heapq.heappush(lower, -heapq.heappop(upper))
+
+      sim = self.sims.get(size, None)
+      if sim is None:
+        continue
+      if size % 2 == 1:
+        median = -lower[0]
+      else:
+        median = (upper[0] - lower[0]) / 2
+      sim.analyse_sums(total, squares, median)
+      sim.index += 1
+
+  def run_simulation(self, repetitions):
+    """ Runs the simulation repetitions number of times, or until every size converged """
+    print "Simulating sample sizes: %d-%d" % (self.sample_sizes[0], self.sample_sizes[-1])
+    max_sample = self.sample_sizes[-1]
+    for i in xrange(repetitions):
+      if (self.width is not None and i % Simulation.adaptive_batch == 0 and
+          all([sim.converged() for sim in self.sims.values()])):
+        print "Stopped after %d repetitions" % i
+        break
+      self.analyse_sample_set([self.rand.choice(self.data) for j in xrange(max_sample)])
+    for s in self.sample_sizes:
+      self.sims[s].analyse_simulation()
+      self.rev_results.extend(self.sims[s].rev_results)
+      self.conf_results.extend(self.sims[s].conf_results)
+
+  def detection_results(self):
+    return [self.sims[s].simulation_result for s in self.sample_sizes]
+
+  def histogram_results(self):
+    results = []
+    for s in self.sample_sizes:
+      results.extend(self.sims[s].histogram_results())
+    return results
+
+class PowerSearch(object):
+  """ Searches for the smallest sample size detecting the threshold with a target power
+
+      The power of a size is the lower of its less and more detection ratios.
+      Sizes are tried from the smallest with a doubling step until one reaches
+      the target, then the last bracket is bisected, so only a logarithmic
+      number of the sample sizes are simulated.  Assumes power grows with the
+      sample size.  Each size is simulated with engine, seeded from seed and
+      given any further keyword arguments.
+  """
+
+  def __init__(self, source_data, sample_sizes, test_name, threshold=0.01, seed=None, width=None,
+               target_power=0.8, engine=Simulation, **engine_options):
+    self.data = source_data
+    self.sample_sizes = sorted(sample_sizes)
+    self.test_name = test_name
+    self.threshold = threshold
+    self.seed = seed
+    self.width = width
+    self.target_power = target_power
+    self.engine = engine
+    self.engine_options = engine_options
+    self.sims = {}
+    self.sample_size = None
+    self.sink = None
+    self.rev_results = []
+    self.conf_results = []
+
+  def set_sink(self, sink):
+    self.sink = sink
+
+  def reaches_power(self, index, repetitions):
+    """ Simulates sample_sizes[index], returning whether it reaches the target power """
+    size = self.sample_sizes[index]
+    seed = self.seed
+    if seed is not None:
+      seed = task_seed(seed, self.test_name, 0, size)
+    sim = self.engine(self.data, size, self.test_name, self.threshold, seed, self.width,
+                      **self.engine_options)
+    sim.set_sink(self.sink)
+    sim.run_simulation(repetitions)
+    self.sims[size] = sim
+    result = sim.simulation_result
+    return min(result['less_ratio'], result['more_ratio']) >= self.target_power
+
+  def run_simulation(self, repetitions):
+    """ Simulates sizes until the smallest reaching the target power is found """
+    last = len(self.sample_sizes) - 1
+    if self.reaches_power(0, repetitions):
+      found = 0
+    else:
+      (low, high, step) = (0, min(1, last), 1)
+      while low < high and not self.reaches_power(high, repetitions):
+        (low, step) = (high, step * 2)
+        high = min(low + step, last)
+      found = None
+      if low < high:
+        while high - low > 1:
+          mid = (low + high) / 2
+          if self.reaches_power(mid, repetitions):
+            high = mid
+          else:
+            low = mid
+        found = high
+
+    if found is None:
+      print "%s: no sample size up to %d reaches power %s" % (self.test_name, self.sample_sizes[-1],
+                                                               self.target_power)
+    else:
+      self.sample_size = self.sample_sizes[found]
+      print "%s: sample size %d reaches power %s" % (self.test_name, self.sample_size,
+                                                     self.target_power)
+    for s in sorted(self.sims.keys()):
+      self.rev_results.extend(self.sims[s].rev_results)
+      self.conf_results.extend(self.sims[s].conf_results)
+
+  def detection_results(self):
+    return [self.sims[s].simulation_result for s in sorted(self.sims.keys())]
+
+  def histogram_results(self):
+    results = []
+    for s in sorted(self.sims.keys()):
+      results.extend(self.sims[s].histogram_results())
+    return results
+
+def wilson_interval(passed, valid, z=1.96):
+  """ The Wilson score interval of a binomial proportion """
+  if valid == 0:
+    return (0.0, 1.0)
+  p = float(passed) / valid
+  centre = p + z * z / (2 * valid)
+  spread = z * math.sqrt(p * (1 - p) / valid + z * z / (4 * valid * valid))
+  scale = 1 + z * z / valid
+  return ((centre - spread) / scale, (centre + spread) / scale)
+
+def ttest_1samp_sums(size, total, squares, popmean):
+  """ The probability of statlib's one sample t-test from integer sums
+
+      The variance is computed exactly from the sum and sum of squares.
+  """
+  df = size - 1
+  mean = float(total) / size
+  variance = float(size * squares - total * total) / (size * df)
+  t = (mean - popmean) / math.sqrt(variance / size)
+  return stats.betai(0.5 * df, 0.5, float(df) / (df + t * t))
+
 def read_data(source_file):
   """ Parses a data file with one observation per line """
   data = []
@@ -135,61 +498,240 @@ def read_data(source_file):
   return data
 
 
-def run_simulations(source_data, repetitions, sample_sizes, test_name, threshold = 0.01):
-  """ Run a series of simulations on the same source data with a set of sample sizes
+def task_seed(seed, test_name, calibration, sample_size):
+  """ Derives the seed of one simulation from the master seed
 
-      Returns a dictionary of key names to arrays of maps with output values.
+      Every (test, calibration round, sample size) gets its own stream, so
+      results don't depend on the order or the process the simulations run in.
   """
+  key = "%d:%s:%d:%d" % (seed, test_name, calibration, sample_size)
+  return int(hashlib.sha1(key).hexdigest()[:8], 16)
+
+class ResultCollector(object):
+  """ A sink keeping the results of the given outputs, dropping the rest """
+  def __init__(self, outputs):
+    self.results = {}
+    for key in outputs:
+      self.results[key] = []
+
+  def __call__(self, key, result):
+    if key in self.results:
+      self.results[key].append(result)
+
+class ResultWriter(object):
+  """ A sink writing the results of the given outputs to csv files as they arrive
+
+      Files are opened on the first result of an output.  When split each
+      source gets its own files, named after the source set by start_source.
+  """
+  def __init__(self, prefix, outputs, split=False):
+    self.prefix = prefix
+    self.outputs = outputs
+    self.split = split
+    self.filename = None
+    self.out_files = {}
+
+  def start_source(self, filename):
+    if self.split:
+      self.close()
+    self.filename = filename
 
-  rev_results = []
-  conf_results = []
-  detection_results = []
+  def __call__(self, key, result):
+    self.write(key, [result])
+
+  def write(self, key, results):
+    if key not in self.outputs:
+      return
+    if key not in self.out_files:
+      if self.split:
+        f = open(self.prefix + "_" + self.filename + "_" + key + ".csv", 'w')
+      else:
+        f = open(self.prefix + "_simulation_" + key + ".csv", 'w')
+      formatter = CSVFormatter(headers=output_headers[key])
+      formatter.output_header(f)
+      self.out_files[key] = (formatter, f)
+    self.out_files[key][0].output_records(results, self.out_files[key][1])
+
+  def write_results(self, results):
+    for key in self.outputs:
+      if key in results:
+        self.write(key, results[key])
+
+  def close(self):
+    for (key, pair) in self.out_files.items():
+      pair[1].close()
+    self.out_files = {}
+
+def run_task(task, sink):
+  """ Runs a single simulation, passing its rev, conf, detect and hist results to sink """
+  (simulation, source_data, repetitions, sample_size, test_name, threshold, seed, options) = task
+  sim = simulation(source_data, sample_size, test_name, threshold, seed, **options)
+  sim.set_sink(sink)
+  sim.run_simulation(repetitions)
+  for result in sim.detection_results():
+    sink('detect', result)
+  for result in sim.histogram_results():
+    sink('hist', result)
+
+def task_unit(task):
+  """ Describes the work of a task, everything its results depend on
+
+      The seed of a task is derived from the master seed and calibration round.
+  """
+  (simulation, source_data, repetitions, sample_size, test_name, threshold, seed, options) = task
+  unit_options = {}
+  for (name, value) in options.items():
+    if isinstance(value, type):
+      value = value.__name__
+    unit_options[name] = value
+  return {'data' : hashlib.sha1(",".join([str(d) for d in source_data])).hexdigest(),
+          'simulation' : simulation.__name__,
+          'sample_size' : sample_size,
+          'test_name' : test_name,
+          'threshold' : threshold,
+          'repetitions' : repetitions,
+          'seed' : seed,
+          'options' : unit_options}
+
+def run_cached_task(cached_task):
+  """ Runs a (cache, task, outputs) tuple, returning the results of the outputs by key
+
+      The results are reused from or stored in the cache if one is given.
+  """
+  (cache, task, outputs) = cached_task
+  seed = task[6]
+  if cache is None or seed is None:
+    collector = ResultCollector(outputs)
+    run_task(task, collector)
+    return collector.results
+  unit = task_unit(task)
+  unit['outputs'] = sorted(outputs)
+  key = unit_key(unit)
+  results = cache.get(key)
+  if results is None:
+    collector = ResultCollector(outputs)
+    run_task(task, collector)
+    results = collector.results
+    cache.put(key, unit, results)
+  return results
+
+def simulation_tasks(source_data, repetitions, sample_sizes, test_name, threshold=0.01,
+                     simulation=Simulation, seed=None, calibration=0, options={}):
+  """ The run_task arguments for simulating each of a set of sample sizes
+
+      A NestedSimulation or PowerSearch covers all of the sizes in a single
+      task.  options are passed on to the simulation as keyword arguments.
+  """
+  if issubclass(simulation, (NestedSimulation, PowerSearch)):
+    if seed is not None:
+      seed = task_seed(seed, test_name, calibration, 0)
+    return [(simulation, source_data, repetitions, list(sample_sizes), test_name, threshold, seed,
+             options)]
+  tasks = []
   for s in sample_sizes:
-    sim = Simulation(source_data, s, test_name)
-    sim.run_simulation(repetitions)
-    rev_results.extend(sim.rev_results)
-    conf_results.extend(sim.conf_results)
-    detection_results.append(sim.simulation_result)
-  return {'rev': rev_results, 'conf': conf_results, 'detect' : detection_results}
+    if seed is None:
+      s_seed = None
+    else:
+      s_seed = task_seed(seed, test_name, calibration, s)
+    tasks.append((simulation, source_data, repetitions, s, test_name, threshold, s_seed, options))
+  return tasks
+
+def run_simulations(source_data, repetitions, sample_sizes, test_name, threshold = 0.01,
+                    simulation=Simulation, seed=None, calibration=0, options={}):
+  """ Run a series of simulations on the same source data with a set of sample sizes
+
+      Returns a dictionary of key names to arrays of maps with output values.
+  """
+  tasks = simulation_tasks(source_data, repetitions, sample_sizes, test_name, threshold,
+                           simulation, seed, calibration, options)
+  collector = ResultCollector(['rev', 'conf', 'detect'])
+  for task in tasks:
+    run_task(task, collector)
+  return collector.results
 
 def run_sim(args):
   print "%r" % args.analysers
-  random.seed()
+  simulation = Simulation
+  options = {}
+  if args.nested:
+    if args.vectorize or args.test != 'ttest':
+      print "--nested can't be combined with --vectorize or a two sample --test"
+      return
+    simulation = NestedSimulation
+  elif args.vectorize or args.test != 'ttest':
+    if not vectorized.available():
+      print "--vectorize and two sample tests require numpy"
+      return
+    simulation = VectorSimulation
+    if args.test != 'ttest':
+      simulation = TwoSampleSimulation
+      options['test'] = args.test
+  if args.ci_width is not None:
+    options['width'] = args.ci_width
+  if args.target_power is not None:
+    if args.nested:
+      print "--target-power can't be combined with --nested"
+      return
+    options.update({'target_power' : args.target_power, 'engine' : simulation})
+    simulation = PowerSearch
+  seed = args.seed
+  if seed is None:
+    if args.cache is not None:
+      print "--cache requires --seed, results are only reused for the same seed"
+      return
+    seed = random.SystemRandom().randint(0, 2**32 - 1)
+  print "Seed: %d" % seed
   samples = range(args.min_sample, args.max_sample+1)
-  out_files = {}
+  outputs = ['rev', 'conf', 'detect']
+  if args.aggregate:
+    outputs = ['detect', 'hist']
+  writer = ResultWriter(args.output, outputs, args.split)
 
+  sources = []
   for source in args.source:
-    source_data = read_data(source)
     filename = os.path.basename(source.name)
-    test_name = filename[0:filename.rfind('.')]
+    sources.append((filename, filename[0:filename.rfind('.')], read_data(source)))
+
+  rounds = []
+  for (filename, test_name, source_data) in sources:
+    for calibration in xrange(args.calibrate):
+      rounds.append(simulation_tasks(source_data, args.repetitions, samples, test_name,
+                                     args.threshold, simulation, seed, calibration, options))
+
+  cache = None
+  if args.cache is not None:
+    cache = ResultCache(args.cache)
+
+  pool = None
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers)
+    task_results = pool.imap(run_cached_task, [(cache, task, outputs)
+                                               for tasks in rounds for task in tasks])
+
+  rounds = iter(rounds)
+  for (filename, test_name, source_data) in sources:
     print "Simulating %s - %s" % (test_name, datetime.now().strftime("%H:%M:%S"))
+    writer.start_source(filename)
 
     for _ in xrange(args.calibrate):
       start = datetime.now()
-      for (key, results) in run_simulations(source_data, args.repetitions,
-                                            samples, test_name, args.threshold).items():
-        if key not in out_files:
-          headers = results[0].keys()
-          if args.split:
-            f = open(args.output + "_" + filename + "_" + key + ".csv", 'w')
-          else:
-            f = open(args.output + "_simulation_" + key + ".csv", 'w')
-          formatter = CSVFormatter(headers=headers)
-          formatter.output_header(f)
-          out_files[key] = (formatter, f)
-
-        out_files[key][0].output_records(results, out_files[key][1])
+      for task in rounds.next():
+        if pool is not None:
+          writer.write_results(task_results.next())
+        elif cache is not None:
+          writer.write_results(run_cached_task((cache, task, outputs)))
+        else:
+          # nothing to keep the results for, so they go straight to the files
+          run_task(task, writer)
       print "Took: %s" % (datetime.now()-start)
 
-    if args.split:
-      for key, pair in out_files.items():
-        pair[1].close()
-        del out_files[key]
-
     print "Finished %s - %s" % (test_name, datetime.now().strftime("%H:%M:%S"))
 
-  for _, pair in out_files.items():
-    pair[1].close()
+  writer.close()
+
+  if pool is not None:
+    pool.close()
+    pool.join()
 
 
 if __name__ == "__main__":
@@ -207,6 +749,31 @@ if __name__ == "__main__":
                       "= mean and median of each sample, conf= confidence "\
                       "probabilities for each sample)", choices=['rev', 'conf', 'detect'],
                       action="append", default=['detect'])
+  parser.add_argument("--aggregate", help="only write detect and hist (histograms of each "\
+                      "test's probabilities) output, never keeping per repetition results",
+                      action="store_true", default=False)
+  parser.add_argument("--workers", help="number of processes to run simulations in",
+                      type=int, default=1)
+  parser.add_argument("--seed", help="master seed the simulations' random streams are "\
+                      "derived from, random if not given", type=int, default=None)
+  parser.add_argument("--cache", help="directory to keep the results of each simulation in, "\
+                      "so a rerun with the same --seed only simulates what is missing. "\
+                      "Requires --seed. See simcache.py to list and evict entries",
+                      default=None)
+  parser.add_argument("--ci-width", dest="ci_width", help="stop simulating a sample size once "\
+                      "the 95%% intervals of its detection ratios are narrower than this, "\
+                      "--repetitions becomes the most run", type=float, default=None)
+  parser.add_argument("--target-power", dest="target_power", help="search for the smallest "\
+                      "sample size whose less and more ratios reach this instead of "\
+                      "simulating every size", type=float, default=None)
+  parser.add_argument("--nested", help="analyse every sample size on prefixes of one "\
+                      "sample drawn per repetition", action="store_true", default=False)
+  parser.add_argument("--test", help="ttest tests each sample against the population mean, "\
+                      "the others test a baseline sample against a second, shifted sample "\
+                      "with numpy", choices=['ttest'] + sorted(two_sample_tests.keys()),
+                      default='ttest')
+  parser.add_argument("--vectorize", help="draw and test all the repetitions of a sample "\
+                      "size at once with numpy", action="store_true", default=False)
 
 
   run_sim(parser.parse_args())
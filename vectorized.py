@@ -0,0 +1,390 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is espull, a log extractor for talos logs stored in ES.
+#
+# The Initial Developer of the Original Code is
+# Stephen Lewchuk (slewchuk@mozilla.com).
+# Portions created by the Initial Developer are Copyright (C) 2011
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+__all__ = ['available', 'ComponentBatch', 'row_totals', 'betai', 'ttest_1samp', 'erfcc',
+           'rank_rows', 'welch_test', 'mann_whitney_test', 'bootstrap_test', 'cusum_ranges']
+
+def available():
+  return numpy is not None
+
+def _sorted_view(data, lengths, strip_max, strip_first):
+  """ Sorts each row of a +inf padded array, returning it with the row lengths """
+  if strip_first:
+    data = data[:, 1:]
+    lengths = lengths - 1
+  data = numpy.sort(data, axis=1)
+  if strip_max:
+    lengths = lengths - 1
+  return (data, lengths)
+
+def _medians(data, lengths):
+  rows = numpy.arange(len(lengths))
+  half = numpy.maximum(lengths, 1) // 2
+  odd = data[rows, half]
+  even = (data[rows, half - 1] + odd) / 2
+  return numpy.where(lengths % 2 == 1, odd, even)
+
+def _averages(data, lengths):
+  """ Means and standard deviations matching analyser.get_average
+
+      The values are summed in sorted order with a cumulative sum, which adds
+      left to right like the builtin sum, so the results are identical.  The
+      squares go through pow with an array exponent because ** 2 becomes a
+      multiplication, which rounds differently from the libm pow used by the
+      builtin.
+  """
+  valid = numpy.arange(data.shape[1]) < lengths[:, numpy.newaxis]
+  totals = numpy.cumsum(numpy.where(valid, data, 0.0), axis=1)[:, -1]
+  avgs = totals / lengths
+  centred = data - avgs[:, numpy.newaxis]
+  twos = numpy.empty_like(centred)
+  twos.fill(2.0)
+  squares = numpy.power(centred, twos)
+  diffs = numpy.where(valid, squares, 0.0)
+  std_devs = numpy.sqrt(numpy.cumsum(diffs, axis=1)[:, -1] / lengths)
+  return (avgs, std_devs)
+
+def _parse_runs(runs):
+  """ Parses comma separated runs into one flat array and the count in each
+
+      numpy parses the joined string in a single pass, anything it can't
+      read goes through float so the error matches the scalar path.
+  """
+  lengths = numpy.array([value.count(',') + 1 for value in runs])
+  try:
+    flat = numpy.fromstring(','.join(runs), sep=',')
+  except ValueError:
+    flat = None
+  if flat is None or len(flat) != lengths.sum():
+    flat = numpy.array([float(v) for value in runs for v in value.split(',')])
+  return (flat, lengths)
+
+class ComponentBatch(object):
+  """ The values and statistics of many components held as arrays
+
+      Each component is a row of a +inf padded 2-D array.  Only the
+      statistics asked for, as (statistic, strip_max, strip_first) keys, are
+      computed, each over every row at once, and kept as lists so a lookup
+      is an index rather than a numpy scalar.  get returns None for
+      statistics which weren't computed or have no values left, so callers
+      fall back to the scalar version and its error.
+  """
+
+  def __init__(self, runs, statistics):
+    (flat, lengths) = _parse_runs(runs)
+    width = lengths.max()
+    self.lengths = lengths
+    self.valid = numpy.arange(width) < lengths[:, numpy.newaxis]
+    self.data = numpy.empty((len(runs), width))
+    self.data.fill(numpy.inf)
+    self.data[self.valid] = flat
+    self.columns = {}
+
+    self.stats = {}
+    views = {}
+    old_settings = numpy.seterr(divide='ignore', invalid='ignore')
+    try:
+      for key in statistics:
+        (stat, strip_max, strip_first) = key
+        if strip_first and width < 2:
+          continue
+        # both strip_max variants share a sort
+        if strip_first not in views:
+          views[strip_first] = _sorted_view(self.data, lengths, False, strip_first)
+        (view, view_lengths) = views[strip_first]
+        if strip_max:
+          view_lengths = view_lengths - 1
+        if stat == 'median':
+          values = _medians(view, view_lengths).tolist()
+        else:
+          (avgs, std_devs) = _averages(view, view_lengths)
+          values = zip(avgs.tolist(), std_devs.tolist())
+        self.stats[key] = (values, (view_lengths > 0).tolist())
+    finally:
+      numpy.seterr(**old_settings)
+
+  def get(self, key, row):
+    if key not in self.stats:
+      return None
+    (values, present) = self.stats[key]
+    if not present[row]:
+      return None
+    return values[row]
+
+  def slice(self, key, start, stop):
+    """ A statistic of rows start to stop, or None unless every row has it """
+    if key not in self.stats:
+      return None
+    (values, present) = self.stats[key]
+    if False in present[start:stop]:
+      return None
+    return values[start:stop]
+
+  def values(self, row):
+    return self.data[row, :self.lengths[row]].tolist()
+
+  def column(self, name):
+    """ The first, count, min or max of every row as a list """
+    if name not in self.columns:
+      if name == 'first':
+        column = self.data[:, 0]
+      elif name == 'count':
+        column = self.lengths
+      elif name == 'min':
+        column = self.data.min(axis=1)
+      else:
+        column = numpy.where(self.valid, self.data, -numpy.inf).max(axis=1)
+      self.columns[name] = column.tolist()
+    return self.columns[name]
+
+def row_totals(data):
+  """ Sums each row left to right, as the builtin sum and statlib do """
+  return numpy.cumsum(data, axis=1)[:, -1]
+
+# Lanczos coefficients of statlib's gammln
+gammln_coeff = [76.18009173, -86.50532033, 24.01409822, -1.231739516,
+                0.120858003e-2, -0.536382e-5]
+
+def gammln(xx):
+  """ Element-wise log gamma, following statlib's gammln """
+  x = xx - 1.0
+  tmp = x + 5.5
+  tmp = tmp - (x + 0.5) * numpy.log(tmp)
+  ser = numpy.ones_like(x)
+  for coeff in gammln_coeff:
+    x = x + 1
+    ser = ser + coeff / x
+  return -tmp + numpy.log(2.50662827465 * ser)
+
+def betacf(a, b, x, itmax=200, eps=3.0e-7):
+  """ Element-wise continued fraction for the incomplete beta function
+
+      Follows statlib's betacf, but every element keeps iterating only until
+      it has converged itself, so each result matches the scalar version.
+  """
+  am = numpy.ones_like(x)
+  bm = numpy.ones_like(x)
+  az = numpy.ones_like(x)
+  qab = a + b
+  qap = a + 1.0
+  qam = a - 1.0
+  bz = 1.0 - qab * x / qap
+  active = numpy.ones(x.shape, dtype=bool)
+  for i in xrange(itmax + 1):
+    em = float(i + 1)
+    tem = em + em
+    d = em * (b - em) * x / ((qam + tem) * (a + tem))
+    ap = az + d * am
+    bp = bz + d * bm
+    d = -(a + em) * (qab + em) * x / ((qap + tem) * (a + tem))
+    app = ap + d * az
+    bpp = bp + d * bz
+    aold = az
+    am = numpy.where(active, ap / bpp, am)
+    bm = numpy.where(active, bp / bpp, bm)
+    az = numpy.where(active, app / bpp, az)
+    bz = numpy.where(active, 1.0, bz)
+    active &= ~(numpy.abs(az - aold) < eps * numpy.abs(az))
+    if not active.any():
+      break
+  return az
+
+def betai(a, b, x):
+  """ Element-wise incomplete beta function, following statlib's betai """
+  a = numpy.broadcast_to(numpy.asarray(a, dtype=float), x.shape)
+  b = numpy.broadcast_to(numpy.asarray(b, dtype=float), x.shape)
+  edge = (x == 0.0) | (x == 1.0)
+  inner = numpy.where(edge, 0.5, x)
+  bt = numpy.exp(gammln(a + b) - gammln(a) - gammln(b) +
+                 a * numpy.log(inner) + b * numpy.log(1.0 - inner))
+  bt = numpy.where(edge, 0.0, bt)
+  # the continued fraction converges on whichever side of the mode x is
+  low = x < (a + 1.0) / (a + b + 2.0)
+  fa = numpy.where(low, a, b)
+  fb = numpy.where(low, b, a)
+  fx = numpy.where(low, x, 1.0 - x)
+  cf = bt * betacf(fa, fb, fx) / fa
+  return numpy.where(low, cf, 1.0 - cf)
+
+def ttest_1samp(data, popmean):
+  """ statlib's one sample t-test applied to every row of a 2-D array
+
+      Returns arrays of the t statistics and two-tailed probabilities.  Rows
+      whose values are all equal have no variance and give nan.
+  """
+  n = data.shape[1]
+  df = n - 1
+  old_settings = numpy.seterr(divide='ignore', invalid='ignore')
+  try:
+    means = row_totals(data) / float(n)
+    deviations = data - means[:, numpy.newaxis]
+    variances = row_totals(deviations * deviations) / float(n - 1)
+    svar = (n - 1) * variances / float(df)
+    t = (means - popmean) / numpy.sqrt(svar * (1.0 / n))
+    x = float(df) / (df + t * t)
+    valid = numpy.isfinite(x)
+    prob = betai(0.5 * df, 0.5, numpy.where(valid, x, 0.5))
+  finally:
+    numpy.seterr(**old_settings)
+  return (t, numpy.where(valid, prob, numpy.nan))
+
+def cusum_ranges(values, mean, rand, bootstraps):
+  """ The CUSUM ranges of bootstraps random reorderings of values
+
+      Matches analyser._cusum_range applied to each reordering, rand is a
+      numpy RandomState.
+  """
+  reordered = numpy.tile(numpy.asarray(values, dtype=float) - mean, (bootstraps, 1))
+  # shuffling each row in place is cheaper than argsorting random keys
+  for row in reordered:
+    rand.shuffle(row)
+  sums = numpy.cumsum(reordered, axis=1)
+  return numpy.maximum(sums.max(axis=1), 0) - numpy.minimum(sums.min(axis=1), 0)
+
+def erfcc(x):
+  """ Element-wise complementary error function, following statlib's erfcc
+
+      Has a fractional error below 1.2e-7.
+  """
+  z = numpy.abs(x)
+  t = 1.0 / (1.0 + 0.5 * z)
+  ans = t * numpy.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 +
+                      t * (-0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 +
+                      t * (-0.82215223 + t * 0.17087277)))))))))
+  return numpy.where(x >= 0, ans, 2.0 - ans)
+
+def rank_rows(data):
+  """ Ranks the values of each row of a 2-D array from 1, giving ties their average rank
+
+      Returns the ranks and each row's sum of t^3 - t over its groups of t
+      tied values, for tie corrections.
+  """
+  (rows, width) = data.shape
+  row_index = numpy.arange(rows)[:, numpy.newaxis]
+  order = numpy.argsort(data, axis=1, kind='mergesort')
+  ordered = data[row_index, order]
+  starts = numpy.ones(data.shape, dtype=bool)
+  starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+  # every row starts a new group, so group ids count up across the whole array
+  groups = numpy.cumsum(starts.ravel()) - 1
+  positions = numpy.tile(numpy.arange(1, width + 1, dtype=float), rows)
+  sizes = numpy.bincount(groups).astype(float)
+  average_ranks = numpy.bincount(groups, weights=positions) / sizes
+  ranks = numpy.empty(data.shape)
+  ranks[row_index, order] = average_ranks[groups].reshape(data.shape)
+  group_rows = numpy.repeat(numpy.arange(rows), starts.sum(axis=1))
+  ties = numpy.bincount(group_rows, weights=sizes ** 3 - sizes, minlength=rows)
+  return (ranks, ties)
+
+def welch_test(a, b, rand=None):
+  """ Two-tailed probabilities of Welch's t-test between the rows of a and b
+
+      Rows where neither sample varies give nan.
+  """
+  (n1, n2) = (a.shape[1], b.shape[1])
+  old_settings = numpy.seterr(divide='ignore', invalid='ignore')
+  try:
+    m1 = row_totals(a) / float(n1)
+    m2 = row_totals(b) / float(n2)
+    d1 = a - m1[:, numpy.newaxis]
+    d2 = b - m2[:, numpy.newaxis]
+    e1 = row_totals(d1 * d1) / float(n1 - 1) / n1
+    e2 = row_totals(d2 * d2) / float(n2 - 1) / n2
+    se2 = e1 + e2
+    t = (m2 - m1) / numpy.sqrt(se2)
+    df = se2 * se2 / (e1 * e1 / (n1 - 1) + e2 * e2 / (n2 - 1))
+    valid = se2 > 0
+    df = numpy.where(valid, df, 1.0)
+    x = numpy.where(valid, df / (df + t * t), 0.5)
+    prob = betai(0.5 * df, 0.5, x)
+  finally:
+    numpy.seterr(**old_settings)
+  return numpy.where(valid, prob, numpy.nan)
+
+def mann_whitney_test(a, b, rand=None):
+  """ Two-tailed probabilities of the Mann-Whitney U test between the rows of a and b
+
+      Uses the normal approximation with a continuity and tie correction.
+      Rows where every value is tied give nan.
+  """
+  (n1, n2) = (a.shape[1], b.shape[1])
+  n = n1 + n2
+  (ranks, ties) = rank_rows(numpy.hstack((a, b)).astype(float))
+  u = row_totals(ranks[:, :n1]) - n1 * (n1 + 1) / 2.0
+  variance = n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1)))
+  valid = variance > 0
+  sigma = numpy.sqrt(numpy.where(valid, variance, 1.0))
+  z = numpy.maximum(numpy.abs(u - n1 * n2 / 2.0) - 0.5, 0.0) / sigma
+  return numpy.where(valid, erfcc(z / numpy.sqrt(2.0)), numpy.nan)
+
+def _welch_statistics(a, b):
+  """ Welch's t statistics between the rows of a and b """
+  m1 = a.mean(axis=1)
+  m2 = b.mean(axis=1)
+  se2 = a.var(axis=1, ddof=1) / a.shape[1] + b.var(axis=1, ddof=1) / b.shape[1]
+  return (m2 - m1) / numpy.sqrt(se2)
+
+def bootstrap_test(a, b, rand, bootstraps=200):
+  """ Two-tailed bootstrap probabilities of Welch's t statistic between the rows of a and b
+
+      Each sample is shifted to the pooled mean, so both follow the null
+      hypothesis, and resampled within itself bootstraps times.  The
+      probability is the share of resampled statistics at least as large as
+      the observed one, counting the observed statistic itself.  Rows where
+      neither sample varies give nan.
+  """
+  (rows, n1) = a.shape
+  n2 = b.shape[1]
+  row_index = numpy.arange(rows)[:, numpy.newaxis]
+  pooled = (row_totals(a) + row_totals(b)) / float(n1 + n2)
+  a_null = a - (a.mean(axis=1) - pooled)[:, numpy.newaxis]
+  b_null = b - (b.mean(axis=1) - pooled)[:, numpy.newaxis]
+  exceeded = numpy.zeros(rows)
+  old_settings = numpy.seterr(divide='ignore', invalid='ignore')
+  try:
+    observed = numpy.abs(_welch_statistics(a, b))
+    for i in xrange(bootstraps):
+      resampled = _welch_statistics(a_null[row_index, rand.randint(0, n1, a.shape)],
+                                    b_null[row_index, rand.randint(0, n2, b.shape)])
+      exceeded += numpy.abs(resampled) >= observed
+  finally:
+    numpy.seterr(**old_settings)
+  return numpy.where(numpy.isnan(observed), numpy.nan, (exceeded + 1) / (bootstraps + 1))